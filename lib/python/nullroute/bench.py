@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# bench - timing harness for the IRC protocol parser and serializer
+from __future__ import print_function
+import io
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+from optparse import OptionParser
+
+import irc
+
+words = ("alpha bravo charlie delta echo foxtrot golf hotel india juliet kilo"
+         " lima mike november oscar papa quebec romeo sierra tango uniform"
+         " victor whiskey xray yankee zulu").split()
+
+numerics = ["001", "005", "332", "333", "353", "366", "372", "433"]
+
+corpus_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "../../tests")
+
+baseline_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             ".bench-baseline.json")
+
+def synth_line(rng, nicks=99):
+    nick = rng.choice(words) + str(rng.randint(1, nicks))
+    prefix = "%s!~%s@%s.example.net" % (nick, nick[:4], nick[:-1])
+    chan = "#" + rng.choice(words)
+    text = " ".join(rng.choice(words) for i in range(rng.randint(1, 20)))
+    kind = rng.random()
+    if kind < 0.45:
+        line = ":%s PRIVMSG %s :%s" % (prefix, chan, text)
+    elif kind < 0.6:
+        line = "@time=2020-01-01T00:00:00.000Z;account=%s;msgid=%x" \
+               " :%s PRIVMSG %s :%s" % (nick, rng.getrandbits(64),
+                                        prefix, chan, text)
+    elif kind < 0.65:
+        line = ":%s PRIVMSG %s :%s" % (prefix, chan, " ".join(
+               rng.choice(words) for i in range(60)))[:510]
+    elif kind < 0.7:
+        line = ":%s PRIVMSG %s :\x01ACTION %s\x01" % (prefix, chan, text)
+    elif kind < 0.75:
+        line = "@+draft/reply=%x;+typing=done :%s TAGMSG %s" \
+               % (rng.getrandbits(32), prefix, chan)
+    elif kind < 0.8:
+        line = ":%s JOIN %s" % (prefix, chan)
+    elif kind < 0.85:
+        line = ":irc.example.net 353 me = %s :%s" \
+               % (chan, " ".join(rng.choice(words) for i in range(30)))
+    elif kind < 0.95:
+        line = ":irc.example.net %s me %s :%s" \
+               % (rng.choice(numerics), chan, text)
+    else:
+        line = "PING :irc.example.net"
+    return (line + "\r\n").encode("utf-8")
+
+def synth_traffic(count, seed=0, nicks=99):
+    rng = random.Random(seed)
+    return [synth_line(rng, nicks) for i in range(count)]
+
+def load_corpus(name, count):
+    """The inputs from one of the lib/tests corpora, repeated to 'count'."""
+    inputs = []
+    with open(os.path.join(corpus_dir, name), "r") as fh:
+        for line in fh:
+            line = line.strip()
+            if not line or line.startswith("//"):
+                continue
+            input, output = json.loads("[%s]" % line)
+            # inputs the function rejects would only time the exception
+            if output is not None:
+                inputs.append(input)
+    return [inputs[i % len(inputs)] for i in range(count)]
+
+def best_of(runs, func, *args):
+    best = None
+    for i in range(runs):
+        t = time.perf_counter()
+        func(*args)
+        t = time.perf_counter() - t
+        best = t if best is None else min(best, t)
+    return best
+
+def allocs(func):
+    """Memory and blocks still allocated by func's results."""
+    tracemalloc.start()
+    result = func()
+    snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    stats = snapshot.statistics("filename")
+    del result
+    return (sum(stat.size for stat in stats),
+            sum(stat.count for stat in stats))
+
+# Each benchmark returns a dict of operations over the same number of lines.
+# They return their results, so that allocs() can count them.
+
+def bench_parse(lines):
+    """Line.split() and Line.parse(), accessing some or all fields."""
+
+    def parse_all():
+        parsed = [irc.Line.parse(line) for line in lines]
+        for p in parsed:
+            p.tags, p.prefix, p.cmd, p.args
+        return parsed
+
+    return {"split": lambda: [irc.Line.split(line) for line in lines],
+            "parse": lambda: [irc.Line.parse(line) for line in lines],
+            "parse + cmd": lambda: [irc.Line.parse(line).cmd
+                                    for line in lines],
+            "parse + all fields": parse_all}
+
+def bench_framing(lines):
+    """Reading lines from a stream: readline() and parse vs. LineBuffer."""
+    data = b"".join(lines)
+    chunks = [data[i:i+16384] for i in range(0, len(data), 16384)]
+
+    def readline():
+        fh = io.BufferedReader(io.BytesIO(data))
+        return [irc.Line.parse(line) for line in iter(fh.readline, b"")]
+
+    def linebuffer():
+        buf = irc.LineBuffer()
+        return [buf.feed(chunk) for chunk in chunks]
+
+    return {"readline + parse": readline,
+            "LineBuffer": linebuffer}
+
+def bench_prefix(lines):
+    """Parsing prefixes, when most messages come from a few active users."""
+    hot = synth_traffic(len(lines), seed=1, nicks=4)
+
+    return {"prefix, %d nicks" % (26 * 99):
+                lambda: [irc.Line.parse(line).prefix for line in lines],
+            "prefix, %d nicks" % (26 * 4):
+                lambda: [irc.Line.parse(line).prefix for line in hot]}
+
+def bench_serialize(lines):
+    """Line.join(), unparse() one line at a time, pack() and fanout()."""
+    parsed = [irc.Line.parse(line) for line in lines]
+    argvs = [p.args for p in parsed]
+    targets = ["#%s%d" % (word, i) for word in words for i in range(4)]
+
+    def fanout_join():
+        return [b"".join([(irc.Line.join(["PRIVMSG", target, "hello world"])
+                           + "\r\n").encode("utf-8") for target in targets])
+                for i in range(0, len(lines), len(targets))]
+
+    def fanout():
+        return [irc.Line.fanout(["PRIVMSG", "hello world"], targets)
+                for i in range(0, len(lines), len(targets))]
+
+    return {"join": lambda: [irc.Line.join(argv) for argv in argvs],
+            "unparse": lambda: [p.unparse() for p in parsed],
+            "pack": lambda: irc.Line.pack(parsed),
+            "fanout, join each": fanout_join,
+            "fanout": fanout}
+
+def bench_corpus(lines):
+    """The lib/tests corpora, each through the function it tests."""
+    count = len(lines)
+    split = [input.encode("utf-8")
+             for input in load_corpus("irc-split.txt", count)]
+    join = load_corpus("irc-join.txt", count)
+    prefix = load_corpus("irc-prefix-split.txt", count)
+    parse = [input.encode("utf-8")
+             for input in load_corpus("irc-parse.txt", count)]
+
+    def parse_all():
+        parsed = [irc.Line.parse(line) for line in parse]
+        for p in parsed:
+            p.tags, p.prefix, p.cmd, p.args
+        return parsed
+
+    return {"irc-split.txt: split":
+                lambda: [irc.Line.split(line) for line in split],
+            "irc-join.txt: join":
+                lambda: [irc.Line.join(argv) for argv in join],
+            # bypassing the cache, as real traffic has more distinct prefixes
+            "irc-prefix-split.txt: Prefix.parse":
+                lambda: [irc.Prefix.parse.__wrapped__(irc.Prefix, input)
+                         for input in prefix],
+            "irc-parse.txt: parse + all fields": parse_all}
+
+def report(name, key, count, val, size, blocks, previous=None):
+    line = "%-10s %-36s %9.0f lines/s %7.0f B/line %5.1f blocks/line" \
+           % (name, key, count / val, size / count, blocks / count)
+    if previous and key in previous:
+        before = previous[key]
+        line += "  (%+.0f%%, %+.0f B)" % ((before["time"] / val - 1) * 100,
+                                         (size - before["bytes"]) / count)
+    print(line)
+
+if __name__ == "__main__":
+    op = OptionParser(usage="%prog [options] [benchmark...]",
+        description="Benchmarks: parse, framing, prefix, serialize, corpus."
+                    " All are run by default. Results are compared with the"
+                    " stored baseline, if there is one.")
+    op.add_option("-n", "--lines", dest="lines", type="int", default=20000,
+        help="number of lines of synthetic traffic")
+    op.add_option("-r", "--runs", dest="runs", type="int", default=3,
+        help="repeat each measurement this many times")
+    op.add_option("-o", "--output", dest="output",
+        help="write results as JSON to this file")
+    op.add_option("-c", "--compare", dest="compare",
+        help="compare with results from an earlier --output file"
+             " (default: %s)" % os.path.basename(baseline_path))
+    op.add_option("-s", "--save", dest="save", action="store_true",
+        help="store the results as the new baseline")
+    opts, args = op.parse_args()
+
+    names = args or ["parse", "framing", "prefix", "serialize", "corpus"]
+
+    previous = {}
+    compare = opts.compare
+    if compare is None and os.path.exists(baseline_path):
+        compare = baseline_path
+    if compare:
+        with open(compare, "r") as fh:
+            data = json.load(fh)
+        if data["lines"] != opts.lines:
+            print("(baseline is for %d lines, not comparing)" % data["lines"],
+                  file=sys.stderr)
+        else:
+            previous = data["results"]
+
+    lines = synth_traffic(opts.lines)
+    all_results = {}
+    for name in names:
+        ops = globals()["bench_%s" % name](lines)
+        all_results[name] = results = {}
+        for key, func in ops.items():
+            val = best_of(opts.runs, func)
+            size, blocks = allocs(func)
+            results[key] = {"time": val, "bytes": size, "blocks": blocks}
+            report(name, key, opts.lines, val, size, blocks,
+                   previous.get(name))
+
+    outputs = [opts.output] if opts.output else []
+    if opts.save:
+        outputs.append(baseline_path)
+    for path in outputs:
+        with open(path, "w") as fh:
+            json.dump({"python": sys.version,
+                       "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                       "lines": opts.lines,
+                       "runs": opts.runs,
+                       "results": all_results}, fh, indent=4)
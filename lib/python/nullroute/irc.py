@@ -1,19 +1,58 @@
 from __future__ import (print_function, unicode_literals)
+import asyncio
 import base64
+import collections
+import functools
 import socket
 import re
+import sys
+import time
+
+# 512 bytes for the message itself (including CR LF), plus up to 8191 bytes
+# of IRCv3 tags
+MAX_LINE_LENGTH = 512 + 8191
+
+# the number of distinct prefixes (i.e. active users) Prefix.parse() remembers
+PREFIX_CACHE_SIZE = 4096
+
+_unset = object()
+
+# IRCv3 message tag value escapes
+_tag_escapes = str.maketrans({";": "\\:", " ": "\\s", "\\": "\\\\",
+                              "\r": "\\r", "\n": "\\n"})
+_tag_unescapes = {":": ";", "s": " ", "\\": "\\", "r": "\r", "n": "\n"}
+_tag_unescape_re = re.compile(r"\\(.?)", re.S)
+
+def _unescape_tag(value):
+    return _tag_unescape_re.sub(lambda m: _tag_unescapes.get(m.group(1),
+                                                             m.group(1)),
+                                value)
 
 class InvalidPrefixError(Exception):
     pass
 
+class LineTooLongError(Exception):
+    pass
+
 class Prefix(object):
+    """
+    The source of an IRC message. Prefix objects are immutable, so that
+    parse() can hand out the same object for every message from a user.
+    """
+
+    __slots__ = ("nick", "user", "host", "is_server")
+
     def __init__(self, nick=None, user=None, host=None, is_server=False):
-        self.nick = nick
-        self.user = user
-        self.host = host
-        self.is_server = is_server
+        object.__setattr__(self, "nick", nick)
+        object.__setattr__(self, "user", user)
+        object.__setattr__(self, "host", host)
+        object.__setattr__(self, "is_server", is_server)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Prefix objects are immutable")
 
     @classmethod
+    @functools.lru_cache(maxsize=PREFIX_CACHE_SIZE)
     def parse(cls, prefix):
         if len(prefix) == 0:
             return None
@@ -27,24 +66,25 @@ class Prefix(object):
         if 0 < dpos < min(upos, hpos):
             return None
 
-        self = cls()
+        nick = user = host = None
+        is_server = False
         if upos > 0:
-            self.nick = prefix[:upos-1]
+            nick = prefix[:upos-1]
             if hpos > 0:
-                self.user = prefix[upos:hpos-1]
-                self.host = prefix[hpos:]
+                user = prefix[upos:hpos-1]
+                host = prefix[hpos:]
             else:
-                self.user = prefix[upos:]
+                user = prefix[upos:]
         elif hpos > 0:
-            self.nick = prefix[:hpos-1]
-            self.host = prefix[hpos:]
+            nick = prefix[:hpos-1]
+            host = prefix[hpos:]
         elif dpos > 0:
-            self.host = prefix
-            self.is_server = True
+            host = prefix
+            is_server = True
         else:
-            self.nick = prefix
+            nick = prefix
 
-        return self
+        return cls(nick, user, host, is_server)
 
     def unparse(self):
         if not (self.nick is None or self.user is None or self.host is None):
@@ -75,106 +115,210 @@ class Prefix(object):
 class Line(object):
     """
     An IRC protocol line.
+
+    Lines returned by parse() only record where each field is in the
+    original buffer; tags, prefix, cmd and args are decoded when first
+    accessed. As in the original parser, their args start with the command
+    itself; lines constructed directly only have the parameters in args.
     """
+
+    __slots__ = ("_buf", "_spans", "_parse_prefix",
+                 "_tags", "_prefix", "_cmd", "_args")
+
+    # command names and numerics, decoded and interned
+    _commands = dict()
+
+    _bad_middle = re.compile(r"^(?::|\Z)|[ \0\r\n]").search
+    _bad_trailing = re.compile(r"[\0\r\n]").search
+    _bad_tag_key = re.compile(r"^\Z|[=; \0\r\n]").search
+
     def __init__(self, tags=None, prefix=None, cmd=None, args=None):
+        self._buf = self._spans = None
         self.tags = tags or {}
         self.prefix = prefix
         self.cmd = cmd
         self.args = args or []
 
-    @classmethod
-    def split(cls, line):
+    @staticmethod
+    def _scan(buf, start=0, end=None):
         """
-        Split an IRC protocol line into tokens as defined in RFC 1459
-        and the IRCv3 message-tags extension.
+        Locate the fields of a raw line in buf[start:end], without copying
+        or decoding anything. Returns the offsets of the tags and prefix
+        (without their sigils, or None), of the command and the middle
+        arguments, of the trailing argument's ':' (or the line's end if
+        there is none), and of the line's end.
         """
 
-        line = line.decode("utf-8", "replace")
-        line = line.rstrip("\r\n").split(" ")
-        i, n = 0, len(line)
-        parv = []
+        if end is None:
+            end = len(buf)
+        while end > start and buf[end-1] in b"\r\n":
+            end -= 1
+        pos = start
+        tags = prefix = None
+
+        while pos < end and buf[pos] == 0x20:
+            pos += 1
+
+        if pos < end and buf[pos] == 0x40:
+            sep = buf.find(b" ", pos, end)
+            if sep < 0:
+                sep = end
+            tags = (pos + 1, sep)
+            pos = sep
+            while pos < end and buf[pos] == 0x20:
+                pos += 1
+
+        if pos < end and buf[pos] == 0x3A:
+            sep = buf.find(b" ", pos, end)
+            if sep < 0:
+                sep = end
+            prefix = (pos + 1, sep)
+            pos = sep
+            while pos < end and buf[pos] == 0x20:
+                pos += 1
+
+        if pos < end and buf[pos] == 0x3A:
+            trail = pos
+        else:
+            trail = buf.find(b" :", pos, end)
+            trail = end if trail < 0 else trail + 1
 
-        while i < n and line[i] == "":
-            i += 1
+        return tags, prefix, pos, trail, end
 
-        if i < n and line[i].startswith("@"):
-            parv.append(line[i])
-            i += 1
-            while i < n and line[i] == "":
-                i += 1
+    @staticmethod
+    def _split_args(buf, pos, trail, end):
+        if trail == pos:
+            args = []
+        else:
+            # if there is a trailing argument, leave out the space before it
+            args = buf[pos:(trail if trail == end else trail - 1)] \
+                       .decode("utf-8", "replace").split(" ")
+            if "" in args:
+                args = [arg for arg in args if arg]
+        if trail < end:
+            args.append(buf[trail+1:end].decode("utf-8", "replace"))
+        return args
 
-        if i < n and line[i].startswith(":"):
-            parv.append(line[i])
-            i += 1
-            while i < n and line[i] == "":
-                i += 1
+    @classmethod
+    def split(cls, line):
+        """
+        Split an IRC protocol line into tokens as defined in RFC 1459
+        and the IRCv3 message-tags extension.
+        """
 
-        while i < n:
-            if line[i].startswith(":"):
-                break
-            elif line[i] != "":
-                parv.append(line[i])
-            i += 1
+        tags, prefix, pos, trail, end = cls._scan(line)
+        parv = cls._split_args(line, pos, trail, end)
 
-        if i < n:
-            trailing = " ".join(line[i:])
-            parv.append(trailing[1:])
+        if prefix:
+            parv.insert(0, line[prefix[0]-1:prefix[1]].decode("utf-8", "replace"))
+        if tags:
+            parv.insert(0, line[tags[0]-1:tags[1]].decode("utf-8", "replace"))
 
         return parv
 
     @classmethod
-    def parse(cls, line, parse_prefix=True):
+    def parse(cls, line, parse_prefix=True, start=0, end=None):
         """
         Parse an IRC protocol line into a Line object consisting of
         tags, prefix, command, and arguments.
-        """
 
-        line = line.decode("utf-8", "replace")
-        parv = line.rstrip("\r\n").split(" ")
-        i, n = 0, len(parv)
-        self = cls()
-
-        while i < n and parv[i] == "":
-            i += 1
-
-        if i < n and parv[i].startswith("@"):
-            tags = parv[i][1:]
-            i += 1
-            while i < n and parv[i] == "":
-                i += 1
-
-            self.tags = dict()
-            for item in tags.split(";"):
-                if "=" in item:
-                    k, v = item.split("=", 1)
-                else:
-                    k, v = item, True
-                self.tags[k] = v
+        The line may also be a slice buf[start:end] of a larger buffer,
+        which the Line then keeps a reference to instead of a copy.
+        """
 
-        if i < n and parv[i].startswith(":"):
-            prefix = parv[i][1:]
-            i += 1
-            while i < n and parv[i] == "":
-                i += 1
+        if not isinstance(line, bytes):
+            line = bytes(line[start:end])
+            start, end = 0, None
 
-            if parse_prefix:
-                self.prefix = Prefix.parse(prefix)
-            else:
-                self.prefix = prefix
-
-        if i < n:
-            self.cmd = parv[i].upper()
+        self = cls.__new__(cls)
+        self._buf = line
+        self._spans = cls._scan(line, start, end)
+        self._parse_prefix = parse_prefix
+        self._tags = self._prefix = self._cmd = self._args = _unset
+        return self
 
-        while i < n:
-            if parv[i].startswith(":"):
-                trailing = " ".join(parv[i:])
-                self.args.append(trailing[1:])
-                break
-            elif parv[i] != "":
-                self.args.append(parv[i])
-            i += 1
+    @property
+    def tags(self):
+        if self._tags is _unset:
+            tags = self._spans[0]
+            self._tags = dict()
+            if tags:
+                for item in self._buf[tags[0]:tags[1]] \
+                                .decode("utf-8", "replace").split(";"):
+                    if "=" in item:
+                        k, v = item.split("=", 1)
+                        if "\\" in v:
+                            v = _unescape_tag(v)
+                    else:
+                        k, v = item, True
+                    self._tags[k] = v
+        return self._tags
+
+    @tags.setter
+    def tags(self, value):
+        self._tags = value
+
+    @property
+    def prefix(self):
+        if self._prefix is _unset:
+            prefix = self._spans[1]
+            self._prefix = None
+            if prefix:
+                self._prefix = self._buf[prefix[0]:prefix[1]] \
+                                   .decode("utf-8", "replace")
+                if self._parse_prefix:
+                    self._prefix = Prefix.parse(self._prefix)
+        return self._prefix
+
+    @prefix.setter
+    def prefix(self, value):
+        self._prefix = value
+
+    @property
+    def cmd(self):
+        if self._cmd is _unset:
+            buf, (_, _, pos, _, end) = self._buf, self._spans
+            self._cmd = None
+            if pos < end:
+                sep = buf.find(b" ", pos, end)
+                if sep < 0:
+                    sep = end
+                raw = buf[pos:sep]
+                cmd = self._commands.get(raw)
+                if cmd is None:
+                    cmd = sys.intern(raw.decode("utf-8", "replace").upper())
+                    # don't let a misbehaving server fill it with junk
+                    if len(self._commands) < 1024:
+                        self._commands[raw] = cmd
+                self._cmd = cmd
+        return self._cmd
+
+    @cmd.setter
+    def cmd(self, value):
+        self._cmd = value
+
+    @property
+    def args(self):
+        if self._args is _unset:
+            _, _, pos, trail, end = self._spans
+            self._args = self._split_args(self._buf, pos, trail, end)
+        return self._args
+
+    @args.setter
+    def args(self, value):
+        self._args = value
 
-        return self
+    @classmethod
+    def _invalid(cls, i, arg):
+        if cls._bad_trailing(arg):
+            reason = "contains line breaks or NULs"
+        elif not arg:
+            reason = "is empty"
+        elif arg.startswith(":"):
+            reason = "starts with ':'"
+        else:
+            reason = "contains spaces"
+        return ValueError("Argument %d %s: %r" % (i, reason, arg))
 
     @classmethod
     def join(cls, argv):
@@ -182,58 +326,206 @@ class Line(object):
 
         if i < n and argv[i].startswith("@"):
             if " " in argv[i]:
-                raise ValueError("Argument %d contains spaces: %r" % (i, argv[i]))
+                raise cls._invalid(i, argv[i])
             i += 1
 
-        if i < n and " " in argv[i]:
-            raise ValueError("Argument %d contains spaces: %r" % (i, argv[i]))
-
-        if i < n and argv[i].startswith(":"):
-            if " " in argv[i]:
-                raise ValueError("Argument %d contains spaces: %r" % (i, argv[i]))
-            i += 1
+        if i < n:
+            # the prefix, or the command even if it is also the last argument
+            arg = argv[i]
+            if not arg or " " in arg:
+                raise cls._invalid(i, arg)
+            if arg[0] == ":":
+                i += 1
 
         while i < n-1:
-            if not argv[i]:
-                raise ValueError("Argument %d is empty: %r" % (i, argv[i]))
-            elif argv[i].startswith(":"):
-                raise ValueError("Argument %d starts with ':': %r" % (i, argv[i]))
-            elif " " in argv[i]:
-                raise ValueError("Argument %d contains spaces: %r" % (i, argv[i]))
+            arg = argv[i]
+            if not arg or arg[0] == ":" or " " in arg:
+                raise cls._invalid(i, arg)
             i += 1
 
-        parv = argv[:i]
+        if i < n and (not argv[i] or argv[i][0] == ":" or " " in argv[i]):
+            line = " ".join(argv[:i]) + " :" + argv[i]
+        else:
+            line = " ".join(argv)
 
-        if i < n:
-            if not argv[i] or argv[i].startswith(":") or " " in argv[i]:
-                parv.append(":%s" % argv[i])
-            else:
-                parv.append(argv[i])
+        # checked once for the whole line, looking for the culprit only
+        # if there is one
+        if "\0" in line or "\r" in line or "\n" in line:
+            for j in range(n):
+                if cls._bad_trailing(argv[j]):
+                    raise cls._invalid(j, argv[j])
 
-        return " ".join(parv)
+        return line
 
-    def unparse(self):
+    @classmethod
+    def join_tags(cls, tags):
+        """
+        Format a dict of IRCv3 message tags, escaping their values.
+        """
+        items = []
+        for k, v in tags.items():
+            if cls._bad_tag_key(k):
+                raise ValueError("Invalid tag name: %r" % k)
+            if v is True or v is None or v == "":
+                items.append(k)
+            elif "\0" in v:
+                raise ValueError("Tag %r contains NULs: %r" % (k, v))
+            else:
+                items.append(k + "=" + v.translate(_tag_escapes))
+        return ";".join(items)
+
+    def _unparse(self):
         parv = []
 
         if self.tags:
-            tags = [k if v is True else k + b"=" + v
-                for k, v in self.tags.items()]
-            parv.append("@" + b",".join(tags))
+            parv.append("@" + self.join_tags(self.tags))
 
         if self.prefix:
-            parv.append(":" + self.prefix.unparse())
+            if isinstance(self.prefix, Prefix):
+                parv.append(":" + self.prefix.unparse())
+            else:
+                parv.append(":" + self.prefix)
+
+        args, cmd = self.args, self.cmd
+        if self._spans is not None and args:
+            # from parse(), so args[0] is the command, possibly since changed
+            if self._cmd is not _unset and cmd != args[0].upper():
+                parv.append(cmd)
+                parv.extend(args[1:])
+            else:
+                parv.extend(args)
+        else:
+            if cmd:
+                parv.append(cmd)
+            parv.extend(args)
 
-        parv.append(self.cmd)
+        return self.join(parv)
 
-        parv.extend(self.args)
+    def unparse(self):
+        """
+        Serialize the line, without CR LF at the end.
+        """
+        return self._unparse().encode("utf-8")
 
-        return self.join(parv)
+    @classmethod
+    def pack(cls, lines):
+        """
+        Serialize several lines into one buffer, each ending with CR LF.
+        """
+        lines = [line._unparse() for line in lines]
+        if not lines:
+            return b""
+        return ("\r\n".join(lines) + "\r\n").encode("utf-8")
+
+    @classmethod
+    def fanout(cls, argv, targets):
+        """
+        Serialize the same message to several targets into one buffer,
+        e.g. a PRIVMSG to many channels. argv is the message without the
+        target, which gets inserted after the command.
+        """
+        argv, targets = list(argv), list(targets)
+        i = 0
+        if i < len(argv) and argv[i].startswith("@"):
+            i += 1
+        if i < len(argv) and argv[i].startswith(":"):
+            i += 1
+        # the command, then a placeholder for the target
+        line = cls.join(argv[:i+1] + ["*"] + argv[i+1:])
+        pos = len(" ".join(argv[:i+1])) + 1
+        head, tail = line[:pos], line[pos+1:] + "\r\n"
+        for target in targets:
+            if cls._bad_middle(target):
+                raise cls._invalid(i + 1, target)
+        if not targets:
+            return b""
+        return (head + (tail + head).join(targets) + tail).encode("utf-8")
+
+    def detach(self):
+        """
+        Copy the line out of the larger buffer it was parsed from, so that
+        keeping the Line doesn't keep the whole buffer alive.
+        """
+        if self._spans is None:
+            return self
+        tags, prefix, pos, trail, end = self._spans
+        start = tags[0] - 1 if tags else prefix[0] - 1 if prefix else pos
+        if start > 0 or end < len(self._buf):
+            shift = lambda span: span and (span[0] - start, span[1] - start)
+            self._buf = self._buf[start:end]
+            self._spans = (shift(tags), shift(prefix),
+                           pos - start, trail - start, end - start)
+        return self
 
     def __repr__(self):
         return "<IRC.Line: tags=%r prefix=%r cmd=%r args=%r>" % (
                         self.tags, self.prefix,
                         self.cmd, self.args)
 
+class LineBuffer(object):
+    """
+    Splits data received in arbitrary chunks into IRC protocol lines.
+
+    Lines are parsed in place, so each Line keeps a reference to the chunk
+    it came from; only a line split across two chunks gets copied. Lines
+    kept around for long (e.g. scrollback) should be detach()ed from it.
+    """
+    def __init__(self, max_length=MAX_LINE_LENGTH, parse_prefix=True):
+        self.max_length = max_length
+        self.parse_prefix = parse_prefix
+        self._partial = b""
+
+    def feed(self, data):
+        """
+        Return the lines completed by this chunk, as a list of Line objects.
+        Raises LineTooLongError if a line (including its line ending) would
+        exceed max_length bytes, after which the connection is best dropped.
+        """
+
+        if not isinstance(data, bytes):
+            data = bytes(data)
+
+        lines = []
+        append = lines.append
+        find = data.find
+        parse = Line.parse
+        max_length = self.max_length
+        parse_prefix = self.parse_prefix
+        pos = 0
+
+        if self._partial:
+            # only the line split across chunks is joined, not the chunk
+            eol = find(b"\n")
+            if eol < 0:
+                self._partial += data
+                if len(self._partial) >= max_length:
+                    raise LineTooLongError("Line exceeds %d bytes" % max_length)
+                return lines
+            line = self._partial + data[:eol]
+            self._partial = b""
+            if len(line) >= max_length:
+                raise LineTooLongError("Line exceeds %d bytes" % max_length)
+            if line != b"\r":
+                append(parse(line, parse_prefix))
+            pos = eol + 1
+
+        while True:
+            eol = find(b"\n", pos)
+            if eol < 0:
+                break
+            if eol - pos >= max_length:
+                raise LineTooLongError("Line exceeds %d bytes" % max_length)
+            # empty lines are silently ignored
+            if eol > pos + 1 or (eol > pos and data[pos] != 0x0D):
+                append(parse(data, parse_prefix, pos, eol))
+            pos = eol + 1
+
+        if len(data) - pos >= self.max_length:
+            raise LineTooLongError("Line exceeds %d bytes" % self.max_length)
+        self._partial = data[pos:]
+
+        return lines
+
 class Connection(object):
     def __init__(self):
         self.host = None
@@ -241,15 +533,14 @@ class Connection(object):
         self.ai = None
         self._fd = None
         self._file = None
+        self._lines = LineBuffer()
+        self._pending = collections.deque()
 
     def connect(self, host, port, ssl=False):
-        self.ai = socket.getaddrinfo(host, str(port), 0, socket.SOCK_STREAM)
-        print(repr(self.ai))
-        for af, proto, _, cname, addr in self.ai:
-            self._fd = socket.socket(af, proto)
-            self._fd.connect(addr)
-            break
-        import io
+        self.host = host
+        self.port = port
+        # tries each getaddrinfo() result in turn
+        self._fd = socket.create_connection((host, port))
         self._fi = self._fd.makefile("rwb")
 
     def writeraw(self, buf):
@@ -260,7 +551,172 @@ class Connection(object):
         return self._fi.readline()
 
     def write(self, *args):
-        self.writeraw(Line.join(args))
+        self.writeraw(Line.join(list(args)).encode("utf-8"))
+
+    def readlines(self):
+        """
+        Receive one chunk of data and return the lines it completed,
+        or None at end of stream.
+        """
+        data = self._fd.recv(16384)
+        if not data:
+            return None
+        return self._lines.feed(data)
 
     def read(self):
-        return Line.parse(self.readraw())
+        while not self._pending:
+            lines = self.readlines()
+            if lines is None:
+                return None
+            self._pending.extend(lines)
+        return self._pending.popleft()
+
+class TokenBucket(object):
+    """
+    Flood control: allows bursts of up to 'burst' lines, after which lines
+    are let through at 'rate' lines per second. The defaults (a burst of 5,
+    then one line every 2 seconds) keep well within typical server limits.
+    """
+    def __init__(self, rate=0.5, burst=5, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = burst
+        self.stamp = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def take(self, count):
+        """
+        Take up to 'count' tokens; returns how many lines may be sent now.
+        """
+        self._refill()
+        count = min(count, int(self.tokens))
+        self.tokens -= count
+        return count
+
+    def delay(self):
+        """
+        Return the number of seconds until the next line may be sent.
+        """
+        self._refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+class AsyncConnection(object):
+    """
+    An IRC connection for asyncio. Received lines are read by iterating
+    over it with 'async for'. Outgoing lines are queued, paced by a
+    TokenBucket, and everything queued by the time the writer task runs
+    is sent with a single write.
+    """
+    def __init__(self, pacer=None, max_length=MAX_LINE_LENGTH):
+        self.host = None
+        self.port = None
+        self.pacer = pacer or TokenBucket()
+        self.error = None
+        self._lines = LineBuffer(max_length)
+        self._incoming = asyncio.Queue()
+        self._outgoing = collections.deque()
+        self._wakeup = asyncio.Event()
+        self._reader = None
+        self._writer = None
+        self._tasks = []
+
+    async def connect(self, host, port, ssl=False, **kwargs):
+        """
+        Connect to the server, trying each of its addresses in turn. For TLS,
+        'ssl' can be True or an ssl.SSLContext; other arguments are passed
+        on to asyncio.open_connection().
+        """
+        self.host = host
+        self.port = port
+        self._reader, self._writer = await asyncio.open_connection(
+                                        host, port, ssl=(ssl or None), **kwargs)
+        self._tasks = [asyncio.ensure_future(self._read_loop()),
+                       asyncio.ensure_future(self._write_loop())]
+
+    async def _read_loop(self):
+        try:
+            while True:
+                data = await self._reader.read(16384)
+                if not data:
+                    break
+                for line in self._lines.feed(data):
+                    self._incoming.put_nowait(line)
+        except (OSError, LineTooLongError) as e:
+            self.error = e
+        finally:
+            self._incoming.put_nowait(None)
+
+    async def _write_loop(self):
+        try:
+            while True:
+                if not self._outgoing:
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                    continue
+                count = self.pacer.take(len(self._outgoing))
+                if not count:
+                    await asyncio.sleep(self.pacer.delay())
+                    continue
+                self._writer.write(b"".join([self._outgoing.popleft()
+                                             for i in range(count)]))
+                await self._writer.drain()
+        except OSError as e:
+            self.error = e
+
+    def _check_writer(self):
+        if self._tasks and self._tasks[1].done():
+            raise self.error or ConnectionError("Connection closed")
+
+    def writeraw(self, buf):
+        # nothing would ever send it
+        self._check_writer()
+        self._outgoing.append(buf + b"\r\n")
+        self._wakeup.set()
+
+    def write(self, *args):
+        self.writeraw(Line.join(list(args)).encode("utf-8"))
+
+    async def flush(self):
+        """
+        Wait until all queued lines have been sent. Raises the writer's
+        error if the connection fails first.
+        """
+        if not self._tasks:
+            if self._outgoing:
+                raise ConnectionError("Not connected")
+            return
+        writer = self._tasks[1]
+        while self._outgoing and not writer.done():
+            await asyncio.wait([writer], timeout=(self.pacer.delay() or 0.01))
+        if self._outgoing:
+            self._check_writer()
+        await self._writer.drain()
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._writer is None:
+            return
+        self._writer.close()
+        try:
+            await self._writer.wait_closed()
+        except OSError:
+            # already broken, which is often why it's being closed
+            pass
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        line = await self._incoming.get()
+        if line is None:
+            # let any further reads end the same way
+            self._incoming.put_nowait(None)
+            raise StopAsyncIteration
+        return line
@@ -1,6 +1,13 @@
 #!/usr/bin/env python
 import sys
 import json
+import asyncio
+import gzip
+import importlib.machinery
+import importlib.util
+import os
+import shutil
+import tempfile
 
 import irc
 
@@ -53,7 +60,9 @@ def test_prefix_split(input):
 
 def test_parse(input):
     input = input.encode("utf-8")
-    p = irc.Line.parse(input)
+    return parse_result(irc.Line.parse(input))
+
+def parse_result(p):
     tags = [k if v is True or v == "" else "%s=%s" % (k, v)
         for k, v in p.tags.items()]
     if tags:
@@ -66,6 +75,328 @@ def test_parse(input):
         prefix = None
     return [tags, prefix, p.args]
 
+def test_split_roundtrip(input):
+    try:
+        line = irc.Line.join(test_split(input))
+        return irc.Line.split(line.encode("utf-8"))
+    except ValueError:
+        return None
+
+def test_join_roundtrip(input):
+    try:
+        line = irc.Line.join(input)
+        return irc.Line.join(irc.Line.split(line.encode("utf-8")))
+    except ValueError:
+        return None
+
+def test_parse_roundtrip(input):
+    input = input.encode("utf-8")
+    try:
+        line = irc.Line.parse(input).unparse()
+        return parse_result(irc.Line.parse(line))
+    except ValueError:
+        return None
+
+def run_tags_test():
+    # tag values -> escaped form, as in the IRCv3 message-tags examples
+    cases = [("a b;c", "a\\sb\\:c"),
+             ("back\\slash", "back\\\\slash"),
+             ("line\r\nbreak", "line\\r\\nbreak"),
+             ("plain", "plain")]
+    passed, failed = 0, 0
+    for value, wanted_output in cases:
+        actual_output = irc.Line.join_tags({"k": value})[2:]
+        parsed = irc.Line.parse(("@k=%s CMD" % actual_output).encode("utf-8"))
+        if actual_output == wanted_output and parsed.tags == {"k": value}:
+            msg = " OK "
+            passed += 1
+        else:
+            msg = "FAIL"
+            failed += 1
+        print("%s: %r -> %s" % (msg, value, actual_output))
+    print("Tests: %s passed, %d failed" % (passed, failed))
+    return failed
+
+def run_unparse_test():
+    # Lines built by the constructor or changed after parsing -> unparse()
+    def changed(raw, **fields):
+        line = irc.Line.parse(raw)
+        for k, v in fields.items():
+            setattr(line, k, v)
+        return line
+    cases = [(irc.Line(cmd="PRIVMSG", args=["#c", "hi there"]),
+              "PRIVMSG #c :hi there"),
+             (irc.Line(prefix=irc.Prefix("n", "u", "h"), cmd="JOIN",
+                       args=["#c"]),
+              ":n!u@h JOIN #c"),
+             (irc.Line(tags={"a": "b c"}, cmd="PING"),
+              "@a=b\\sc PING"),
+             (changed(b":n!u@h privmsg #c :hi there", cmd="NOTICE"),
+              ":n!u@h NOTICE #c :hi there"),
+             (changed(b":n!u@h privmsg #c :hi there", prefix=None,
+                      args=["PRIVMSG", "#d", "bye"]),
+              "PRIVMSG #d bye"),
+             (irc.Line.parse(b":n!u@h privmsg #c :hi there"),
+              ":n!u@h privmsg #c :hi there")]
+    passed, failed = 0, 0
+    for line, wanted_output in cases:
+        actual_output = line.unparse().decode("utf-8")
+        if wanted_output == actual_output:
+            msg = " OK "
+            passed += 1
+        else:
+            msg = "FAIL"
+            failed += 1
+        print("%s: %r -> %s" % (msg, line, actual_output))
+    print("Tests: %s passed, %d failed" % (passed, failed))
+    return failed
+
+def run_framing_test(file):
+    # feed the whole corpus as one stream, in chunks of various sizes
+    inputs = [input for input, _ in parse_test(file) if input]
+    wanted_output = [test_parse(input) for input in inputs]
+    data = "".join("%s\r\n" % input for input in inputs).encode("utf-8")
+    passed, failed = 0, 0
+    for size in [1, 2, 3, 7, 64, len(data)]:
+        buf = irc.LineBuffer()
+        lines = []
+        for i in range(0, len(data), size):
+            lines += buf.feed(data[i:i+size])
+        for p in lines[1::2]:
+            p.detach()
+        actual_output = [parse_result(p) for p in lines]
+        if wanted_output == actual_output:
+            msg = " OK "
+            passed += 1
+        else:
+            msg = "FAIL"
+            failed += 1
+        print("%s: %d-byte chunks -> %d lines" % (msg, size, len(lines)))
+    print("Tests: %s passed, %d failed" % (passed, failed))
+    return failed
+
+def run_pacing_test():
+    # (seconds elapsed, lines queued) -> lines allowed through
+    steps = [(0, 8, 5), (0, 3, 0), (1, 3, 0), (2, 3, 1), (10, 2, 2), (100, 9, 5)]
+    now = [0]
+    bucket = irc.TokenBucket(rate=0.5, burst=5, clock=lambda: now[0])
+    passed, failed = 0, 0
+    for elapsed, count, wanted_output in steps:
+        now[0] = elapsed
+        actual_output = bucket.take(count)
+        if wanted_output == actual_output:
+            msg = " OK "
+            passed += 1
+        else:
+            msg = "FAIL"
+            failed += 1
+        print("%s: %d lines at %ds -> %d" % (msg, count, elapsed, actual_output))
+    print("Tests: %s passed, %d failed" % (passed, failed))
+    return failed
+
+async def async_session(abort):
+    # a server that greets, records what it gets, and then either goes
+    # away (abort) or waits for the client to hang up
+    received = []
+    done = asyncio.Event()
+    async def serve(reader, writer):
+        writer.write(b":irc.example.net 001 me :Welcome\r\nPING :x\r\n")
+        if abort:
+            writer.transport.abort()
+            done.set()
+            return
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            received.append(line)
+        writer.close()
+        done.set()
+    server = await asyncio.start_server(serve, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+
+    conn = irc.AsyncConnection(pacer=irc.TokenBucket(rate=1000, burst=100))
+    await conn.connect("127.0.0.1", port)
+    result = []
+    async for line in conn:
+        result.append(line.cmd)
+        if line.cmd == "PING":
+            break
+    try:
+        conn.write("PONG", "x")
+        conn.write("PRIVMSG", "#c", "hi there")
+        await asyncio.wait_for(conn.flush(), 5)
+        # after an abort, the first write may still be accepted
+        conn.write("QUIT")
+        await asyncio.wait_for(conn.flush(), 5)
+    except ConnectionError:
+        result.append("error")
+    await asyncio.wait_for(conn.close(), 5)
+    await asyncio.wait_for(done.wait(), 5)
+    try:
+        conn.write("QUIT")
+    except ConnectionError:
+        result.append("refused")
+    server.close()
+    await server.wait_closed()
+    return result + [line.decode() for line in received]
+
+async def unconnected_session():
+    conn = irc.AsyncConnection()
+    result = []
+    await conn.flush()
+    result.append("empty")
+    conn.write("NICK", "me")
+    try:
+        await conn.flush()
+    except ConnectionError as e:
+        result.append(str(e))
+    await conn.close()
+    return result
+
+def run_async_test():
+    cases = [(False, ["001", "PING", "refused", "PONG x\r\n",
+                      "PRIVMSG #c :hi there\r\n", "QUIT\r\n"]),
+             (True, ["001", "PING", "error", "refused"])]
+    passed, failed = 0, 0
+    for abort, wanted_output in cases:
+        try:
+            actual_output = asyncio.run(async_session(abort))
+        except Exception as e:
+            actual_output = repr(e)
+        if wanted_output == actual_output:
+            msg = " OK "
+            passed += 1
+        else:
+            msg = "FAIL"
+            failed += 1
+        print("%s: %s -> %r" % (msg, "abort" if abort else "normal",
+                                actual_output))
+    wanted_output = ["empty", "Not connected"]
+    try:
+        actual_output = asyncio.run(unconnected_session())
+    except Exception as e:
+        actual_output = repr(e)
+    if wanted_output == actual_output:
+        msg = " OK "
+        passed += 1
+    else:
+        msg = "FAIL"
+        failed += 1
+    print("%s: %s -> %r" % (msg, "unconnected", actual_output))
+    print("Tests: %s passed, %d failed" % (passed, failed))
+    return failed
+
+def load_logindex():
+    here = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, os.path.join(here, ".."))
+    path = os.path.join(here, "../../../net/irc-logindex")
+    loader = importlib.machinery.SourceFileLoader("logindex", path)
+    spec = importlib.util.spec_from_loader("logindex", loader)
+    logindex = importlib.util.module_from_spec(spec)
+    # for pickling index_chunk() off to the worker processes
+    sys.modules["logindex"] = logindex
+    loader.exec_module(logindex)
+    # small chunks, so that a few lines are split across several workers
+    logindex.CHUNK_SIZE = 100
+    return logindex
+
+log_lines = [b"1577836800 :a!u@h PRIVMSG #c :hello",
+             b"1577836900 :b!u@h JOIN #c",
+             b"1577923200 :a!u@h PRIVMSG #d :bye",
+             b"[2021-03-04 10:00:00] :b!u@h PRIVMSG #c :later",
+             b"@time=2021-03-05T00:00:00.000Z :a!u@h NOTICE #c :tagged",
+             b"PING :irc.example.net"]
+
+def logindex_session(logindex, dir):
+    # the results of each step, as (test name, actual, wanted) triples
+    lines = log_lines
+    log = os.path.join(dir, "a.log")
+    gz = os.path.join(dir, "b.log.gz")
+    with open(log, "wb") as fh:
+        fh.write(b"\n".join(lines) + b"\n")
+    with gzip.open(gz, "wb") as fh:
+        fh.write(lines[0] + b"\n")
+    index = logindex.Index(os.path.join(dir, "index.db"))
+    def update():
+        return index.update([log, gz], jobs=2)
+    def search(since=None, until=None, **terms):
+        return [line.rstrip(b"\r\n")
+                for path, line in index.search(sorted(terms.items()),
+                                               since, until)]
+    update()
+
+    yield ("nick a", search(nick="a"),
+           [lines[0], lines[2], lines[4], lines[0]])
+    yield ("nick a in #c", search(nick="a", chan="#c"),
+           [lines[0], lines[4], lines[0]])
+    yield ("PRIVMSG to #c in 2021",
+           search(cmd="PRIVMSG", chan="#c",
+                  since=logindex.parse_day("2021-01-01"),
+                  until=logindex.parse_day("2021-12-31")),
+           [lines[3]])
+    yield ("PING", search(cmd="PING"), [lines[5]])
+
+    # a line still being written, crossing a chunk boundary
+    pad = b"1609459200 :c!u@h PRIVMSG #c :" + b"x" * 100
+    unfinished = b"1609459201 :d!u@h PRIVMSG #c :unfin" + b"x" * 150
+    with open(log, "ab") as fh:
+        fh.write(pad + b"\n" + unfinished)
+    update()
+    yield ("unfinished line", search(nick="d"), [])
+    with open(log, "ab") as fh:
+        fh.write(b"ished\n")
+    update()
+    yield ("finished line", search(nick="d"), [unfinished + b"ished"])
+    yield ("appended once", search(nick="c"), [pad])
+
+    # a last line that stays without a newline
+    last = b"1609459202 :e!u@h PRIVMSG #c :no newline"
+    with open(log, "ab") as fh:
+        fh.write(last)
+    update()
+    yield ("last line, still written to", search(nick="e"), [])
+    update()
+    yield ("last line, unchanged since", search(nick="e"), [last])
+    yield ("last line, indexed once", [update(), search(nick="e")], [0, [last]])
+
+    # rewritten in place (copytruncate), larger than what was indexed
+    with open(log, "r+b") as fh:
+        fh.truncate(0)
+        fh.write(b"\n".join(lines[1:2] * 40) + b"\n")
+    update()
+    yield ("copytruncate", search(nick="a", chan="#c") + search(nick="e"),
+           [lines[0]])
+
+    # rewritten logs are indexed again from the start
+    with gzip.open(gz, "wb") as fh:
+        fh.write(lines[2] + b"\n")
+    with open(log + ".new", "wb") as fh:
+        fh.write(lines[1] + b"\n")
+    os.rename(log + ".new", log)
+    update()
+    yield ("rewritten", search(nick="a") + search(nick="b"),
+           [lines[2], lines[1]])
+
+def run_logindex_test():
+    logindex = load_logindex()
+    dir = tempfile.mkdtemp(prefix="irc-logindex.")
+    passed, failed = 0, 0
+    try:
+        for name, actual_output, wanted_output in \
+                logindex_session(logindex, dir):
+            if wanted_output == actual_output:
+                msg = " OK "
+                passed += 1
+            else:
+                msg = "FAIL"
+                failed += 1
+            print("%s: %s -> %r" % (msg, name, actual_output))
+    finally:
+        shutil.rmtree(dir)
+    print("Tests: %s passed, %d failed" % (passed, failed))
+    return failed
+
 dir = "../../tests"
 
 f = 0
@@ -73,6 +404,15 @@ f += run_test(dir+"/irc-split.txt", test_split)
 f += run_test(dir+"/irc-join.txt", test_join)
 f += run_test(dir+"/irc-prefix-split.txt", test_prefix_split)
 f += run_test(dir+"/irc-parse.txt", test_parse)
+f += run_test(dir+"/irc-split.txt", test_split_roundtrip)
+f += run_test(dir+"/irc-join.txt", test_join_roundtrip)
+f += run_test(dir+"/irc-parse.txt", test_parse_roundtrip)
+f += run_tags_test()
+f += run_unparse_test()
+f += run_framing_test(dir+"/irc-parse.txt")
+f += run_pacing_test()
+f += run_async_test()
+f += run_logindex_test()
 
 print("Total: %d failed" % f)
 
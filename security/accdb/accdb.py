@@ -5,16 +5,45 @@
 from __future__ import print_function
 import cmd
 import fnmatch
+import gc
+import hashlib
+import heapq
+import io
+import json
+import marshal
+import mmap
 import os
 import re
+import select
 import shlex
+import signal
+import shutil
+import socket
+import struct
 import subprocess
 import sys
+import tempfile
 import time
+import urllib.parse
 import uuid
-from collections import OrderedDict
+import zlib
+from array import array
+from bisect import bisect_left, insort
+from collections import Counter, OrderedDict, defaultdict
+from contextlib import contextmanager
+from functools import lru_cache
 from base64 import b64encode, b64decode
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    from re import _parser as sre_parse, _constants as sre_constants
+except ImportError:
+    import sre_parse, sre_constants
+
 debug = os.environ.get("DEBUG", "")
 
 field_names = {
@@ -39,26 +68,62 @@ field_groups = {
 
 field_order = ["object", "username", "password", "email"]
 
+# position of each grouped field, in the above order
+field_rank = {field: rank for rank, field in
+              enumerate(field for group in field_order
+                              for field in field_groups[group])}
+
 field_prefix_re = re.compile(r"^\W+")
 
+@lru_cache(maxsize=None)
 def strip_field_prefix(name):
     return field_prefix_re.sub("", name)
 
 def sort_fields(entry, terse=False):
-    names = []
-    for group in field_order:
-        for field in field_groups[group]:
-            names += sorted((k for k in entry.attributes \
-                     if k == field),
-                    key=strip_field_prefix)
+    names = sorted((k for k in entry.attributes if k in field_rank),
+                   key=field_rank.__getitem__)
     if not terse:
-        names += sorted((k for k in entry.attributes if k not in names),
+        names += sorted((k for k in entry.attributes if k not in field_rank),
                 key=strip_field_prefix)
     return names
 
 def translate_field(name):
     return field_names.get(name, name)
 
+# characters that need a hostname to be parsed as an URI
+host_special_re = re.compile(r"[/:@\[?#]")
+
+def normalize_host(value):
+    """Reduce a hostname or URI to a lowercase hostname without "www."."""
+    host = value.strip().lower()
+    if host_special_re.search(host):
+        if "://" not in host:
+            host = "//" + host
+        try:
+            host = urllib.parse.urlsplit(host).hostname or ""
+        except ValueError:
+            return value.strip().lower()
+    host = host.rstrip(".")
+    if host.startswith("www."):
+        host = host[4:]
+    return host
+
+def blocking_keys(entry):
+    """
+    Keys under which an entry is grouped when looking for duplicates: each
+    of its hosts paired with each of its logins or email addresses.
+    """
+    objects = {normalize_host(value)
+               for field in field_groups["object"]
+               for value in entry.attributes.get(field, [])}
+    idents = {value.strip().lower()
+              for group in ["username", "email"]
+              for field in field_groups[group]
+              for value in entry.attributes.get(field, [])}
+    objects.discard("")
+    idents.discard("")
+    return {(obj, ident) for obj in objects for ident in idents or {None}}
+
 def split_ranges(string):
     for i in string.split():
         for j in i.split(","):
@@ -84,9 +149,188 @@ def re_compile_glob(glob, flags=None):
         flags = re.I | re.U
     return re.compile(fnmatch.translate(glob), flags)
 
+def glob_literal(glob):
+    """Return the literal prefix of a glob, up to the first wildcard."""
+    for pos, char in enumerate(glob):
+        if char in "*?[":
+            return glob[:pos]
+    return glob
+
+def fold_case(string):
+    # Only ASCII strings can be folded with lower() without disagreeing
+    # with re.I (which also matches e.g. 'ſ' to 's'); callers put the rest
+    # into a separate always-checked bucket.
+    if string.isascii():
+        return string.lower()
+    return None
+
+def regex_literals(pattern):
+    """
+    Return the literal strings that any match of a regex must contain
+    (not necessarily all of them), case-folded as by fold_case().
+    """
+    c = sre_constants
+    groups = {c.SUBPATTERN, getattr(c, "ATOMIC_GROUP", None)}
+    repeats = {c.MAX_REPEAT, c.MIN_REPEAT, getattr(c, "POSSESSIVE_REPEAT", None)}
+    literals = []
+
+    def walk(parsed):
+        run = ""
+        for op, av in parsed:
+            if op == c.LITERAL:
+                run += chr(av)
+                continue
+            elif op == c.AT:
+                # zero-width, doesn't break up the run
+                continue
+            literals.append(run)
+            run = ""
+            if op in groups:
+                walk(av[-1] if op == c.SUBPATTERN else av)
+            elif op in repeats and av[0] >= 1:
+                walk(av[2])
+        literals.append(run)
+
+    try:
+        walk(sre_parse.parse(pattern))
+    except (re.error, RecursionError):
+        return []
+    return [lit for lit in map(fold_case, literals) if lit]
+
+def glob_literals(glob):
+    return regex_literals(fnmatch.translate(glob))
+
+def trigrams(string):
+    return {string[i:i+3] for i in range(len(string) - 2)}
+
+def posting_add(postings, item):
+    if not postings or postings[-1] < item:
+        postings.append(item)
+    else:
+        insort(postings, item)
+
+def posting_remove(postings, item):
+    pos = bisect_left(postings, item)
+    if pos < len(postings) and postings[pos] == item:
+        del postings[pos]
+
+def posting_contains(postings, item):
+    pos = bisect_left(postings, item)
+    return pos < len(postings) and postings[pos] == item
+
+@contextmanager
+def gc_paused():
+    # Loading or indexing the database creates a few hundred thousand small
+    # objects, none of them cyclic; letting the GC rescan them over and over
+    # makes that several times slower.
+    if gc.isenabled():
+        gc.disable()
+        try:
+            yield
+        finally:
+            gc.enable()
+    else:
+        yield
+
 def trace(msg, *args):
     print("accdb: %s" % msg, *args, file=sys.stderr)
 
+class Profiler(object):
+    """
+    Per-phase wall time and entry counts, enabled through $ACCDB_PROFILE
+    (or --profile). The variable holds comma-separated options: "1" for
+    just the timings, "memory" to also trace the peak of Python memory use,
+    and "cprofile=FILE" to also write cProfile stats to FILE.
+
+    Phases may nest; each reports the time not spent in nested phases.
+    """
+
+    def __init__(self, spec=""):
+        self.enabled = False
+        self.memory = False
+        self.cprofile_path = None
+        self.stats = OrderedDict()
+        self.stack = []
+        self.configure(spec)
+
+    def configure(self, spec):
+        for opt in filter(None, spec.split(",")):
+            self.enabled = True
+            if opt == "memory":
+                self.memory = True
+            elif opt.startswith("cprofile="):
+                self.cprofile_path = opt[len("cprofile="):]
+
+    def start(self):
+        if not self.enabled:
+            return
+        self.started = time.perf_counter()
+        if self.memory:
+            import tracemalloc
+            tracemalloc.start()
+        if self.cprofile_path:
+            import cProfile
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        self.stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            total = time.perf_counter() - start
+            nested = self.stack.pop()
+            if self.stack:
+                self.stack[-1] += total
+            stat = self.stats.setdefault(name, [0.0, 0, 0])
+            stat[0] += total - nested
+            stat[1] += 1
+
+    def count(self, name, count):
+        if self.enabled:
+            self.stats.setdefault(name, [0.0, 0, 0])[2] += count
+
+    def iterate(self, name, iterable):
+        """Time only the iteration itself, counting the items."""
+        if not self.enabled:
+            return iterable
+        def wrapper():
+            it = iter(iterable)
+            while True:
+                with self.phase(name):
+                    try:
+                        item = next(it)
+                    except StopIteration:
+                        return
+                self.count(name, 1)
+                yield item
+        return wrapper()
+
+    def report(self, fh=sys.stderr):
+        """Print one "accdb-profile:" line per phase, in key=value form."""
+        if not self.enabled:
+            return
+        if self.cprofile_path:
+            self.cprofile.disable()
+            self.cprofile.dump_stats(self.cprofile_path)
+        for name, (wall, calls, count) in self.stats.items():
+            print("accdb-profile: phase=%s wall=%.6f calls=%d count=%d" \
+                % (name, wall, calls, count),
+                file=fh)
+        line = "accdb-profile: phase=total wall=%.6f" \
+            % (time.perf_counter() - self.started)
+        if self.memory:
+            import tracemalloc
+            line += " peak_bytes=%d" % tracemalloc.get_traced_memory()[1]
+        print(line, file=fh)
+
+profiler = Profiler(os.environ.get("ACCDB_PROFILE", ""))
+
 def start_editor(path):
     if "VISUAL" in os.environ:
         editor = shlex.split(os.environ["VISUAL"])
@@ -139,6 +383,39 @@ def split_filter(text):
     elif depth < 0:
         raise FilterSyntaxError("too many ')'s (depth %d)" % depth)
 
+def split_records(fh):
+    """
+    Tokenize database text (any iterable of lines, or a string) in a single
+    pass. Yields ("modeline", lineno, line), ("flags", lineno, line) and
+    ("entry", lineno, lines) records, the latter with a list of (lineno,
+    line) pairs for the entry starting at lineno.
+    """
+    if isinstance(fh, str):
+        fh = fh.splitlines(True)
+
+    lines = []
+    lastno = 1
+
+    for lineno, line in enumerate(fh, 1):
+        char = line[:1]
+        if char == ";" and line.startswith("; vim:"):
+            yield "modeline", lineno, line
+            continue
+        elif char == ";" and line.startswith("; dbflags:"):
+            yield "flags", lineno, line
+            continue
+        elif char == "=":
+            if lines:
+                yield "entry", lastno, lines
+            lines = []
+            lastno = lineno
+        for part in line.splitlines():
+            lines.append((lineno, part))
+
+    if lines:
+        yield "entry", lastno, lines
+
+@lru_cache(maxsize=128)
 def compile_filter(pattern):
     tokens = split_filter(pattern)
     if debug:
@@ -168,57 +445,100 @@ def compile_filter(pattern):
     else:
         return PatternFilter(tokens[0])
 
-def compile_pattern(pattern):
-    func = None
+def pattern_source(pattern, ns):
+    """
+    Translate a search pattern to a Python expression testing `entry`,
+    storing any constants it needs in the namespace `ns`. Returns the
+    expression and a rough cost estimate for ordering AND/OR operands.
+    """
+    def const(value):
+        name = "_c%d" % len(ns)
+        ns[name] = value
+        return name
 
     if pattern == "*":
-        func = lambda entry: True
+        return "True", 0
     elif pattern.startswith("#"):
         try:
             val = int(pattern[1:])
         except ValueError:
-            func = lambda entry: False
+            return "False", 0
         else:
-            func = lambda entry: entry.itemno == val
+            return "entry.itemno == %d" % val, 0
     elif pattern.startswith("+"):
-        regex = re_compile_glob(pattern[1:])
-        func = lambda entry: any(regex.match(tag) for tag in entry.tags)
+        regex = const(re_compile_glob(pattern[1:]))
+        return "any(map(%s.match, entry.tags))" % regex, 2
     elif pattern.startswith("@"):
         if "=" in pattern:
             attr, glob = pattern[1:].split("=", 1)
             attr = translate_field(attr)
-            regex = re_compile_glob(glob)
-            func = lambda entry:\
-                attr in entry.attributes \
-                and any(regex.match(value)
-                    for value in entry.attributes[attr])
+            regex = const(re_compile_glob(glob))
+            return "any(map(%s.match, entry.attributes.get(%r, ())))" \
+                   % (regex, attr), 3
         elif "~" in pattern:
             attr, regex = pattern[1:].split("~", 1)
             attr = translate_field(attr)
-            regex = re.compile(regex, re.I | re.U)
-            func = lambda entry:\
-                attr in entry.attributes \
-                and any(regex.search(value)
-                    for value in entry.attributes[attr])
+            regex = const(re.compile(regex, re.I | re.U))
+            return "any(map(%s.search, entry.attributes.get(%r, ())))" \
+                   % (regex, attr), 4
         elif "*" in pattern:
-            regex = re_compile_glob(pattern[1:])
-            func = lambda entry:\
-                any(regex.match(attr) for attr in entry.attributes)
+            regex = const(re_compile_glob(pattern[1:]))
+            return "any(map(%s.match, entry.attributes))" % regex, 3
         else:
             attr = translate_field(pattern[1:])
-            func = lambda entry: attr in entry.attributes
+            return "%r in entry.attributes" % attr, 1
     elif pattern.startswith("~"):
-        regex = re.compile(pattern[1:], re.I | re.U)
-        func = lambda entry: regex.search(entry.name)
+        regex = const(re.compile(pattern[1:], re.I | re.U))
+        return "%s.search(entry.name) is not None" % regex, 4
     else:
-        regex = re_compile_glob(pattern + "*")
-        func = lambda entry: regex.match(entry.name)
+        regex = const(re_compile_glob(pattern + "*"))
+        return "%s.match(entry.name) is not None" % regex, 3
 
-    return func
+def compile_predicate(source, ns):
+    if debug:
+        trace("compiled predicate: %s" % source)
+    return eval("lambda entry: %s" % source, ns)
+
+def compile_pattern(pattern):
+    ns = {}
+    source, cost = pattern_source(pattern, ns)
+    return compile_predicate(source, ns)
 
 class Filter(object):
+    # Filters can be evaluated by walking the tree with test(), but calling
+    # the filter uses source() to flatten the whole tree into one function.
+    _predicate = None
+
     def __call__(self, entry):
-        return bool(self.test(entry))
+        return self.predicate(entry)
+
+    @property
+    def predicate(self):
+        if self._predicate is None:
+            ns = {}
+            source, cost = self.source(ns)
+            self._predicate = compile_predicate(source, ns)
+        return self._predicate
+
+    def _operands(self, ns):
+        parts = []
+        for filter in self.filters:
+            if type(filter) is type(self):
+                parts += filter._operands(ns)
+            else:
+                parts.append(filter.source(ns))
+        # cheapest checks first, since 'and'/'or' stop early
+        parts.sort(key=lambda part: part[1])
+        return parts
+
+    def plan(self, index):
+        """
+        Rewrite the filter into index lookups. Returns a set of candidate
+        item numbers (None if every entry is a candidate) and a residual
+        filter that candidates still have to pass (None if they all match).
+        The returned set may belong to the index and must not be modified.
+        """
+        return None, self
 
 class PatternFilter(Filter):
     def __init__(self, pattern):
@@ -229,6 +549,13 @@ class PatternFilter(Filter):
         if self.func:
             return self.func(entry)
 
+    def source(self, ns):
+        return pattern_source(self.pattern, ns)
+
+    def plan(self, index):
+        cands, exact = index.lookup(self.pattern)
+        return cands, (None if exact else self)
+
     def __repr__(self):
         return "(PATTERN %s)" % self.pattern
 
@@ -239,6 +566,31 @@ class ConjunctionFilter(Filter):
     def test(self, entry):
         return all(filter.test(entry) for filter in self.filters)
 
+    def source(self, ns):
+        parts = self._operands(ns)
+        if not parts:
+            return "True", 0
+        return "(%s)" % " and ".join(expr for expr, _ in parts), \
+               sum(cost for _, cost in parts)
+
+    def plan(self, index):
+        plans = [filter.plan(index) for filter in self.filters]
+        plans.sort(key=lambda plan: index.estimate(plan[0]))
+        cands = None
+        for subcands, _ in plans:
+            if subcands is None:
+                break
+            cands = subcands if cands is None else cands & subcands
+            if not cands:
+                return set(), None
+        residual = [subfilter for _, subfilter in plans if subfilter]
+        if not residual:
+            return cands, None
+        elif len(residual) == 1:
+            return cands, residual[0]
+        else:
+            return cands, ConjunctionFilter(*residual)
+
     def __repr__(self):
         return "(AND %s)" % " ".join(repr(f) for f in self.filters)
 
@@ -249,6 +601,25 @@ class DisjunctionFilter(Filter):
     def test(self, entry):
         return any(filter.test(entry) for filter in self.filters)
 
+    def source(self, ns):
+        parts = self._operands(ns)
+        if not parts:
+            return "False", 0
+        return "(%s)" % " or ".join(expr for expr, _ in parts), \
+               sum(cost for _, cost in parts)
+
+    def plan(self, index):
+        plans = [filter.plan(index) for filter in self.filters]
+        if (None, None) in plans:
+            return None, None
+        elif any(subcands is None for subcands, _ in plans):
+            return None, self
+        cands = set().union(*[subcands for subcands, _ in plans])
+        if any(subfilter for _, subfilter in plans):
+            return cands, self
+        else:
+            return cands, None
+
     def __repr__(self):
         return "(OR %s)" % " ".join(repr(f) for f in self.filters)
 
@@ -259,62 +630,567 @@ class NegationFilter(Filter):
     def test(self, entry):
         return not self.filter.test(entry)
 
+    def source(self, ns):
+        expr, cost = self.filter.source(ns)
+        return "(not %s)" % expr, cost
+
+    def plan(self, index):
+        subcands, subfilter = self.filter.plan(index)
+        if subfilter:
+            return None, self
+        elif subcands is None:
+            return set(), None
+        else:
+            return index.items - subcands, None
+
     def __repr__(self):
         return "(NOT %r)" % self.filter
 
+class Index(object):
+    """
+    Inverted indexes over a Database's entries, mapping tags, attribute
+    names, attribute values and name prefixes to sets of item numbers.
+    """
+
+    PREFIX_LEN = 3
+
+    def __init__(self, trigrams=False):
+        self.items = set()
+        self.tags = dict()
+        self.attrs = dict()
+        self.values = dict()
+        self.prefixes = dict()
+        # optional trigram postings (sorted arrays of item numbers) for
+        # regex and substring searches over names and attribute values
+        self.trigrams = trigrams
+        self.name_grams = dict()
+        self.value_grams = dict()
+
+    def to_structure(self):
+        def grams(index):
+            return {gram: postings.tobytes()
+                    for gram, postings in index.items()}
+        return (self.trigrams, self.items, self.tags, self.attrs,
+                self.values, self.prefixes, grams(self.name_grams),
+                {key: grams(index) for key, index in self.value_grams.items()})
+
+    @classmethod
+    def from_structure(self, data):
+        def grams(index):
+            return {gram: array("I", postings)
+                    for gram, postings in index.items()}
+        index = self(data[0])
+        (index.items, index.tags, index.attrs,
+         index.values, index.prefixes) = data[1:6]
+        index.name_grams = grams(data[6])
+        index.value_grams = {key: grams(i) for key, i in data[7].items()}
+        return index
+
+    def _keys(self, entry):
+        for tag in entry.tags:
+            yield self.tags, tag
+        for key, values in entry.attributes.items():
+            yield self.attrs, key
+            if key not in self.values:
+                self.values[key] = dict()
+            for value in values:
+                yield self.values[key], fold_case(value)
+        yield self.prefixes, fold_case(entry.name[:self.PREFIX_LEN])
+
+    @staticmethod
+    def _trigrams(string):
+        folded = fold_case(string)
+        return {None} if folded is None else trigrams(folded)
+
+    def _grams(self, entry):
+        # private values are left out, there's little reason to grep them
+        yield self.name_grams, self._trigrams(entry.name)
+        for key, values in entry.attributes.items():
+            if entry.is_private_attr(key):
+                continue
+            if key not in self.value_grams:
+                self.value_grams[key] = dict()
+            yield self.value_grams[key], set().union(*map(self._trigrams, values))
+
+    def add_all(self, entries):
+        """Bulk version of add() for a sequence of new entries."""
+        pending = defaultdict(lambda: defaultdict(list))
+        for entry in entries:
+            self.items.add(entry.itemno)
+            for index, key in self._keys(entry):
+                if key in index:
+                    index[key].add(entry.itemno)
+                else:
+                    index[key] = {entry.itemno}
+            if self.trigrams:
+                for index, grams in self._grams(entry):
+                    index = pending[id(index)]
+                    for gram in grams:
+                        index[gram].append(entry.itemno)
+        for index in [self.name_grams, *self.value_grams.values()]:
+            for gram, items in pending[id(index)].items():
+                if gram in index:
+                    for item in items:
+                        posting_add(index[gram], item)
+                else:
+                    index[gram] = array("I", sorted(items))
+
+    def add(self, entry):
+        self.items.add(entry.itemno)
+        for index, key in self._keys(entry):
+            if key in index:
+                index[key].add(entry.itemno)
+            else:
+                index[key] = {entry.itemno}
+        if self.trigrams:
+            for index, grams in self._grams(entry):
+                for gram in grams:
+                    if gram in index:
+                        posting_add(index[gram], entry.itemno)
+                    else:
+                        index[gram] = array("I", [entry.itemno])
+
+    def remove(self, entry):
+        self.items.discard(entry.itemno)
+        for index, key in self._keys(entry):
+            if key in index:
+                index[key].discard(entry.itemno)
+                if not index[key]:
+                    del index[key]
+        if self.trigrams:
+            for index, grams in self._grams(entry):
+                for gram in grams:
+                    if gram in index:
+                        posting_remove(index[gram], entry.itemno)
+                        if not index[gram]:
+                            del index[gram]
+
+    # Lookup
+
+    def estimate(self, cands):
+        return len(self.items) if cands is None else len(cands)
+
+    def _union(self, index, regex):
+        return set().union(*[items for key, items in index.items()
+                             if regex.match(key)])
+
+    def _union_prefix(self, index, prefix):
+        return set().union(*[items for key, items in index.items()
+                             if key is not None and key.startswith(prefix)],
+                           index.get(None, ()))
+
+    def _lookup_grams(self, index, literals):
+        # index is None for attributes without trigram postings (private ones)
+        grams = set().union(*map(trigrams, literals))
+        if not (self.trigrams and grams) or index is None:
+            return None
+        postings = sorted((index.get(gram, ()) for gram in grams), key=len)
+        cands = set(postings[0])
+        for items in postings[1:]:
+            if not cands:
+                break
+            elif len(cands) * 16 < len(items):
+                cands = {i for i in cands if posting_contains(items, i)}
+            else:
+                cands.intersection_update(items)
+        return cands.union(index.get(None, ()))
+
+    def lookup(self, pattern):
+        """
+        Find candidates for a single search pattern (as in compile_pattern).
+        Returns a set of item numbers or None if every entry is a candidate,
+        and whether the set is exact (i.e. no need to test the pattern).
+        """
+        if pattern == "*":
+            return None, True
+        elif pattern.startswith("#"):
+            try:
+                val = int(pattern[1:])
+            except ValueError:
+                return set(), True
+            else:
+                return {val} & self.items, True
+        elif pattern.startswith("+"):
+            regex = re_compile_glob(pattern[1:])
+            return self._union(self.tags, regex), True
+        elif pattern.startswith("@"):
+            if "=" in pattern:
+                attr, glob = pattern[1:].split("=", 1)
+                attr = translate_field(attr)
+                return self._lookup_value(attr, glob), False
+            elif "~" in pattern:
+                attr, regex = pattern[1:].split("~", 1)
+                attr = translate_field(attr)
+                cands = self._lookup_grams(self.value_grams.get(attr),
+                                           regex_literals(regex))
+                if cands is None:
+                    cands = self.attrs.get(attr, set())
+                return cands, False
+            elif "*" in pattern:
+                regex = re_compile_glob(pattern[1:])
+                return self._union(self.attrs, regex), True
+            else:
+                attr = translate_field(pattern[1:])
+                return self.attrs.get(attr, set()), True
+        elif pattern.startswith("~"):
+            return self._lookup_grams(self.name_grams,
+                                      regex_literals(pattern[1:])), False
+        else:
+            return self._lookup_name(pattern), False
+
+    def _lookup_value(self, attr, glob):
+        literal = fold_case(glob_literal(glob))
+        if attr not in self.values:
+            return set()
+        elif not literal:
+            cands = self._lookup_grams(self.value_grams.get(attr),
+                                       glob_literals(glob))
+            if cands is None:
+                cands = self.attrs.get(attr, set())
+            return cands
+        elif len(literal) == len(glob):
+            values = self.values[attr]
+            return values.get(literal, set()) | values.get(None, set())
+        else:
+            return self._union_prefix(self.values[attr], literal)
+
+    def _lookup_name(self, pattern):
+        literal = fold_case(glob_literal(pattern))
+        if not literal:
+            return self._lookup_grams(self.name_grams, glob_literals(pattern))
+        elif len(literal) >= self.PREFIX_LEN:
+            prefix = literal[:self.PREFIX_LEN]
+            return self.prefixes.get(prefix, set()) \
+                   | self.prefixes.get(None, set())
+        else:
+            return self._union_prefix(self.prefixes, literal)
+
+class Columns(object):
+    """
+    Attribute values stored by attribute rather than by entry: for each
+    attribute name, a mapping of item numbers to the entries' value lists.
+    Used to answer @attr=glob and @attr~regex patterns that the index can
+    only narrow down, by scanning one column instead of each entry's dict.
+    Each column is built when first searched.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.columns = dict()
+
+    def column(self, attr):
+        column = self.columns.get(attr)
+        if column is None:
+            with profiler.phase("columns"):
+                column = {entry.itemno: entry.attributes[attr]
+                          for entry in self.db if attr in entry.attributes}
+            self.columns[attr] = column
+        return column
+
+    # Only columns already built are kept up to date; with none built, the
+    # entry isn't even looked at, so lazily loaded ones stay unparsed.
+
+    def add(self, entry):
+        for attr, column in self.columns.items():
+            if attr in entry.attributes:
+                column[entry.itemno] = entry.attributes[attr]
+
+    def remove(self, entry):
+        for attr, column in self.columns.items():
+            column.pop(entry.itemno, None)
+
+    def lookup(self, pattern, cands=None):
+        """
+        Return the item numbers (out of cands, if given) of entries matching
+        an attribute value pattern, or None for other kinds of patterns.
+        """
+        if not pattern.startswith("@"):
+            return None
+        elif "=" in pattern:
+            attr, glob = pattern[1:].split("=", 1)
+            test = re_compile_glob(glob).match
+        elif "~" in pattern:
+            attr, regex = pattern[1:].split("~", 1)
+            test = re.compile(regex, re.I | re.U).search
+        else:
+            return None
+        column = self.column(translate_field(attr))
+        if cands is not None and len(cands) < len(column):
+            get = column.get
+            return {item for item in cands
+                    if any(map(test, get(item, ())))}
+        else:
+            items = {item for item, values in column.items()
+                     if any(map(test, values))}
+            return items if cands is None else items & cands
+
+    def narrow(self, cands, residual):
+        """
+        Resolve the attribute value patterns left in a query plan's residual
+        filter (on its own or ANDed with others) using column scans.
+        """
+        if isinstance(residual, PatternFilter):
+            filters = [residual]
+        elif isinstance(residual, ConjunctionFilter):
+            filters = residual.filters
+        else:
+            return cands, residual
+        rest = []
+        for filter in filters:
+            items = None
+            if isinstance(filter, PatternFilter):
+                items = self.lookup(filter.pattern, cands)
+            if items is None:
+                rest.append(filter)
+            else:
+                cands = items
+        if not rest:
+            return cands, None
+        elif len(rest) == 1:
+            return cands, rest[0]
+        else:
+            return cands, ConjunctionFilter(*rest)
+
+class NameIndex(object):
+    """
+    Trigram index over normalized entry names, for ranking entries by how
+    similar their names are to a possibly misspelt query. Deleted entries
+    are left out.
+    """
+
+    def __init__(self):
+        self.grams = dict()
+        self.sizes = dict()
+
+    @staticmethod
+    def _grams(name):
+        # padded, so that short names and word boundaries count too
+        name = " %s " % name
+        return {name[i:i+3] for i in range(len(name) - 2)}
+
+    def add(self, entry):
+        if entry.deleted:
+            return
+        grams = self._grams(entry.normalized_name)
+        for gram in grams:
+            if gram in self.grams:
+                self.grams[gram].add(entry.itemno)
+            else:
+                self.grams[gram] = {entry.itemno}
+        self.sizes[entry.itemno] = len(grams)
+
+    def remove(self, entry):
+        if entry.itemno not in self.sizes:
+            return
+        for gram in self._grams(entry.normalized_name):
+            self.grams[gram].discard(entry.itemno)
+        del self.sizes[entry.itemno]
+
+    def search(self, query, limit=10):
+        """
+        Return up to limit (score, itemno) pairs, best first, scoring by the
+        Dice coefficient of the query's and names' trigrams.
+        """
+        match = Entry.RE_COLL.search(query)
+        grams = self._grams(match.group(0).lower() if match else query)
+        counts = Counter()
+        for gram in grams:
+            counts.update(self.grams.get(gram, ()))
+        size = len(grams)
+        scores = ((2 * count / (size + self.sizes[item]), -item)
+                  for item, count in counts.items())
+        return [(score, -item)
+                for score, item in heapq.nlargest(limit, scores)]
+
 class Database(object):
     def __init__(self):
         self.count = 0
         self.path = None
         self.entries = dict()
         self.order = list()
+        # item numbers stay with their entries when 'order' is sorted
+        self.itemnos = dict()
+        self.sorted = False
         self.modified = False
         self.readonly = False
         self._modeline = "; vim: ft=accdb:"
         self.flags = set()
         self._adduuids = True
+        self._index = None
+        self._names = None
+        self.columns = Columns(self)
+        self._results = OrderedDict()
+        self.generation = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._mmap = None
+        self._journal = None
+        self._changes = None
+        self._touched = False
+        self.journaled = 0
+        # the file as it was when loaded or last written (see Journal.identify)
+        self._base = None
 
     # Import
 
     @classmethod
-    def from_file(self, path):
+    def from_file(self, path, readonly=False, lazy=False):
         db = self()
         db.path = path
-        with open(path, "r", encoding="utf-8") as fh:
-            db.parseinto(fh)
+        db.readonly = readonly
+        journal = Journal.open(path)
+        if journal is None:
+            db._base = Journal.identify(path)
+            db._load(lazy)
+        else:
+            # keeps a compaction from emptying the journal between the two
+            with journal.locked():
+                db._base = Journal.identify(path)
+                db._load(lazy)
+                with profiler.phase("journal"):
+                    db.journaled = journal.replay(db)
+                profiler.count("journal", db.journaled)
+            db._journal = journal
+        db._changes = []
         return db
 
+    def _load(self, lazy=False):
+        if lazy:
+            with profiler.phase("scan"):
+                self.scaninto(self.path)
+            profiler.count("scan", self.count)
+            return self
+        with profiler.phase("snapshot"):
+            loaded = Snapshot.load(self)
+        if loaded:
+            profiler.count("snapshot", self.count)
+            return self
+        with open(self.path, "rb") as fh:
+            raw = fh.read()
+            st = os.fstat(fh.fileno())
+        with profiler.phase("parse"):
+            with io.TextIOWrapper(io.BytesIO(raw), encoding="utf-8") as fh:
+                self.parseinto(fh)
+        profiler.count("parse", self.count)
+        if not self.readonly:
+            with profiler.phase("store"):
+                Snapshot.store(self, st, raw)
+        return self
+
+    def reload(self):
+        """
+        Reread the file after another process has rewritten it, dropping all
+        entries loaded before. The journal is left to the caller.
+        """
+        fresh = Database()
+        fresh.path = self.path
+        fresh.readonly = self.readonly
+        base = Journal.identify(self.path)
+        fresh._load()
+        for name in ("count", "entries", "order", "itemnos", "sorted",
+                     "flags", "_modeline", "_index", "_mmap"):
+            setattr(self, name, getattr(fresh, name))
+        self._names = None
+        self.columns = Columns(self)
+        self._results.clear()
+        self.generation += 1
+        self._base = base
+        return self
+
     @classmethod
     def parse(self, *args, **kwargs):
         return self().parseinto(*args, **kwargs)
 
     def parseinto(self, fh):
-        data = ""
-        lineno = 0
-        lastno = 1
+        with gc_paused():
+            for kind, lineno, data in split_records(fh):
+                if kind == "modeline":
+                    self._modeline = data.strip()
+                elif kind == "flags":
+                    self.flags = split_tags(data[10:])
+                else:
+                    entry = Entry().parselines(data, lineno)
+                    if entry:
+                        self.add(entry)
 
-        for line in fh:
-            lineno += 1
-            if line.startswith("; vim:"):
-                self._modeline = line.strip()
-            elif line.startswith("; dbflags:"):
-                self.flags = split_tags(line[10:])
-            elif line.startswith("="):
-                entry = Entry.parse(data, lineno=lastno)
+        return self
+
+    RE_SCAN = re.compile(rb"^(?:; vim:|; dbflags:|=|[ \t]+=|[ \t]*\{).*",
+                         re.M)
+
+    def scaninto(self, path):
+        """
+        Load a database lazily: only find where each entry starts in the
+        (mmap'd) file, along with its name and UUID, and leave the rest to
+        be parsed when first needed. See LazyEntry.
+        """
+        with open(path, "rb") as fh:
+            try:
+                self._mmap = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # empty file
+                return self
+        with gc_paused():
+            return self._scaninto(self._mmap)
+
+    def _scaninto(self, buf):
+        entry = None
+        segments = [[0, None]]
+        lineno = 1
+        lastpos = 0
+
+        def finish(entry, segments, end):
+            segments[-1][1] = end
+            if entry is None or entry._eager:
+                data = b"".join(buf[a:b] for a, b in segments)
+                entry = Entry.parse(data.decode("utf-8"),
+                                    lineno=(1 if entry is None else entry.lineno))
                 if entry:
                     self.add(entry)
-                data = line
-                lastno = lineno
             else:
-                data += line
-
-        if data:
-            entry = Entry.parse(data, lineno=lastno)
-            if entry:
+                entry._segments = segments
                 self.add(entry)
 
+        for m in self.RE_SCAN.finditer(buf):
+            line = m.group(0).rstrip(b"\r")
+            lineno += buf[lastpos:m.start()].count(b"\n")
+            lastpos = m.start()
+            if line.startswith(b"; vim:"):
+                self._modeline = line.decode("utf-8").strip()
+            elif line.startswith(b"; dbflags:"):
+                self.flags = split_tags(line[10:].decode("utf-8"))
+            elif line.startswith(b"="):
+                finish(entry, segments, m.start())
+                entry = LazyEntry(buf, line[1:].decode("utf-8").strip(),
+                                  lineno)
+                segments = [[m.start(), None]]
+                continue
+            elif entry is not None and line.lstrip().startswith(b"{") \
+                       and line.endswith(b"}") and not entry.uuid:
+                try:
+                    entry.uuid = uuid.UUID(line.strip().decode("utf-8"))
+                except ValueError:
+                    entry._eager = True
+                continue
+            else:
+                # anything the header scan can't be sure about (repeated
+                # UUIDs or names within the entry) is left to Entry.parse
+                if entry is not None:
+                    entry._eager = True
+                continue
+            # modeline and flags don't belong to the surrounding entry
+            segments[-1][1] = m.start()
+            segments.append([m.end() + 1, None])
+
+        finish(entry, segments, len(buf))
         return self
 
+    def materialize(self):
+        """Parse all lazily loaded entries, e.g. before overwriting the file."""
+        for entry in self.entries.values():
+            if isinstance(entry, LazyEntry):
+                entry.materialize()
+
     def add(self, entry, lineno=None):
         if entry.uuid is None:
             entry.uuid = uuid.uuid4()
@@ -322,6 +1198,8 @@ class Database(object):
             raise KeyError("Duplicate UUID %s" % entry.uuid)
 
         entry.itemno = self.count + 1
+        entry.touch()
+        self.generation += 1
 
         self.count += 1
 
@@ -333,10 +1211,19 @@ class Database(object):
         # TODO: Can this be relied upon? Not documented anywhere.
         self.entries[entry.uuid] = entry
         self.order.append(entry.uuid)
+        self.itemnos[entry.itemno] = entry.uuid
+
+        if self._index is not None:
+            self._index.add(entry)
+        if self._names is not None:
+            self._names.add(entry)
+        self.columns.add(entry)
+        if self._changes is not None:
+            self._changes.append(("add", entry))
 
         return entry
 
-    def replace(self, entry):
+    def replace(self, entry, history=True):
         if entry.uuid is None:
             raise ValueError("Entry is missing UUID")
 
@@ -345,8 +1232,11 @@ class Database(object):
         entry.itemno = oldentry.itemno
         entry.lineno = oldentry.lineno
 
-        oldpass = oldentry.attributes.get("pass", None)
-        newpass = entry.attributes.get("pass", None)
+        if history:
+            oldpass = oldentry.attributes.get("pass", None)
+            newpass = entry.attributes.get("pass", None)
+        else:
+            oldpass = newpass = None
 
         if oldpass and oldpass != newpass:
             if "!pass.old" not in entry.attributes:
@@ -355,12 +1245,119 @@ class Database(object):
                 p = "%s (until %s)" % (p.dump(), time.strftime("%Y-%m-%d"))
                 entry.attributes["!pass.old"].append(PrivateAttribute(p))
 
+        entry.touch()
+        self.generation += 1
         self.entries[entry.uuid] = entry
 
+        if self._index is not None:
+            self._index.remove(oldentry)
+            self._index.add(entry)
+        if self._names is not None:
+            self._names.remove(oldentry)
+            self._names.add(entry)
+        self.columns.remove(oldentry)
+        self.columns.add(entry)
+        if self._changes is not None:
+            self._changes.append(("replace", entry))
+
         return entry
 
+    def merge(self, entries):
+        """
+        Add or replace entries in bulk, matching them by UUID. Returns lists
+        of the entries which were new, changed, identical to the existing
+        ones (and hence skipped), or broken (also skipped).
+        """
+        report = {"new": [], "changed": [], "identical": [], "broken": []}
+        updates = []
+        # keep the index out of the way, it is updated (or dropped) at the end
+        index, self._index = self._index, None
+        try:
+            for entry in entries:
+                if entry._broken:
+                    report["broken"].append(entry)
+                    continue
+                oldentry = self.entries.get(entry.uuid)
+                if oldentry is None:
+                    self.add(entry)
+                    report["new"].append(entry)
+                elif entry.same_as(oldentry):
+                    report["identical"].append(oldentry)
+                    continue
+                else:
+                    self.replace(entry)
+                    report["changed"].append(entry)
+                updates.append((oldentry, entry))
+        finally:
+            if index is not None and len(updates) <= len(self.order) // 10:
+                for oldentry, entry in updates:
+                    if oldentry is not None:
+                        index.remove(oldentry)
+                    index.add(entry)
+                self._index = index
+        if updates:
+            self.modified = True
+        return report
+
     # Lookup
 
+    def duplicates(self):
+        """
+        Find groups of entries sharing a blocking key (see blocking_keys),
+        joining groups that overlap. Returns (keys, entries) pairs.
+        """
+        buckets = defaultdict(list)
+        for entry in self:
+            if entry.deleted:
+                continue
+            for key in blocking_keys(entry):
+                buckets[key].append(entry.itemno)
+
+        # union-find over item numbers
+        parent = {}
+        def find(item):
+            parent.setdefault(item, item)
+            while parent[item] != item:
+                parent[item] = parent[parent[item]]
+                item = parent[item]
+            return item
+        for items in buckets.values():
+            root = find(items[0])
+            for item in items[1:]:
+                other = find(item)
+                if other != root:
+                    parent[other] = root
+
+        groups = defaultdict(lambda: (set(), set()))
+        for key, items in buckets.items():
+            if len(items) > 1:
+                keys, members = groups[find(items[0])]
+                keys.add(key)
+                members.update(items)
+        return [(sorted(keys, key=str),
+                 [self.find_by_itemno(item) for item in sorted(members)])
+                for keys, members in sorted(groups.values(),
+                                            key=lambda g: min(g[1]))]
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = Index(trigrams=("trigrams" in self.flags))
+            with gc_paused(), profiler.phase("index"):
+                self._index.add_all(self)
+            profiler.count("index", self.count)
+        return self._index
+
+    @property
+    def names(self):
+        if self._names is None:
+            self._names = NameIndex()
+            with gc_paused(), profiler.phase("names"):
+                for entry in self:
+                    self._names.add(entry)
+            profiler.count("names", self.count)
+        return self._names
+
     def __contains__(self, key):
         return key in self.entries
 
@@ -368,28 +1365,86 @@ class Database(object):
         return self.entries[key]
 
     def find_by_itemno(self, itemno):
-        uuid = self.order[itemno-1]
+        try:
+            uuid = self.itemnos[itemno]
+        except KeyError:
+            raise IndexError("No item %r" % itemno)
         entry = self.entries[uuid]
         assert entry.itemno == itemno
         return entry
 
+    # number of queries whose results are kept by find_cached()
+    RESULT_CACHE_SIZE = 64
+
     def find(self, filter):
-        for entry in self:
-            if filter(entry):
-                yield entry
+        return profiler.iterate("filter", self._find(filter))
+
+    def find_cached(self, filter):
+        """
+        Like find(), but remembers the results of recent queries until the
+        database is next changed. Returns a list.
+        """
+        key = (repr(filter), self.generation)
+        uuids = self._results.get(key)
+        if uuids is None:
+            self.cache_misses += 1
+            results = list(self.find(filter))
+            if self._results and next(iter(self._results))[1] != key[1]:
+                # everything older is stale anyway
+                self._results.clear()
+            self._results[key] = tuple(entry.uuid for entry in results)
+            if len(self._results) > self.RESULT_CACHE_SIZE:
+                self._results.popitem(last=False)
+        else:
+            self.cache_hits += 1
+            self._results.move_to_end(key)
+            results = [self.entries[uuid] for uuid in uuids]
+        if debug:
+            trace("result cache: %d hits, %d misses" % \
+                (self.cache_hits, self.cache_misses))
+        return results
+
+    def _find(self, filter):
+        cands, residual = filter.plan(self.index)
+        cands, residual = self.columns.narrow(cands, residual)
+        if debug:
+            trace("query plan: %s candidates, residual %s" % \
+                ("all" if cands is None else len(cands), residual))
+        if cands is None:
+            entries = iter(self)
+        elif self.sorted:
+            # keep the order that sort() chose
+            entries = (entry for entry in self if entry.itemno in cands)
+        else:
+            entries = (self.find_by_itemno(i) for i in sorted(cands))
+        if residual is None:
+            yield from entries
+        else:
+            test = residual.predicate
+            for entry in entries:
+                if test(entry):
+                    yield entry
 
     # Aggregate lookup
 
     def tags(self):
-        tags = set()
-        for entry in self:
-            tags |= entry.tags
-        return tags
+        return set(self.index.tags)
 
     # Maintenance
 
     def sort(self):
         self.order.sort(key=lambda uuid: self.entries[uuid].normalized_name)
+        self.sorted = True
+        self.generation += 1
+
+    def touch(self):
+        """
+        Forget the stored form of all entries, forcing a full rewrite (also
+        when the database is journaled).
+        """
+        for entry in self:
+            entry.touch()
+        self._touched = True
 
     # Export
 
@@ -398,38 +1453,107 @@ class Database(object):
             yield self.entries[uuid]
 
     def dump(self, fh=sys.stdout, storage=True):
-        eargs = {"storage": storage,
-            "conceal": ("conceal" in self.flags)}
         if storage:
-            if self._modeline:
-                print(self._modeline, file=fh)
+            fh.write(self.dumps())
+            return
+        conceal = ("conceal" in self.flags)
         for entry in self:
             if entry.deleted:
                 continue
-            print(entry.dump(**eargs), file=fh)
-        if storage:
-            if self.flags:
-                print("; dbflags: %s" % \
-                    ", ".join(sorted(self.flags)),
-                    file=fh)
+            print(entry.dump(storage=False, conceal=conceal), file=fh)
 
-    def to_structure(self):
-        return [entry.to_structure() for entry in self]
-
-    def dump_yaml(self, fh=sys.stdout):
+    def dumps(self, layout=None):
+        """
+        Return the storage form of the database, reusing the stored form of
+        entries that haven't changed since the last save or load. If given a
+        list, appends the (entry, lineno) of each entry written to it.
+        """
+        conceal = ("conceal" in self.flags)
+        data = []
+        lineno = 1
+        if self._modeline:
+            data.append(self._modeline + "\n")
+            lineno += 1
+        for entry in self:
+            if entry.deleted:
+                continue
+            text = entry.dump_stored(conceal) + "\n"
+            if layout is not None:
+                layout.append((entry, lineno))
+                lineno += text.count("\n")
+            data.append(text)
+        if self.flags:
+            data.append("; dbflags: %s\n" % ", ".join(sorted(self.flags)))
+        return "".join(data)
+
+    def to_structure(self, conceal=True):
+        return [entry.to_structure(conceal) for entry in self]
+
+    # The exporters below write one entry at a time, instead of building
+    # the whole structure first, and can be given a subset of entries.
+
+    def dump_yaml(self, fh=sys.stdout, entries=None, conceal=True):
         import yaml
-        print(yaml.dump(self.to_structure()), file=fh)
-
-    def dump_json(self, fh=sys.stdout):
-        import json
-        print(json.dumps(self.to_structure(), indent=4), file=fh)
-
-    def to_file(self, path):
-        with open(path, "w", encoding="utf-8", newline="\n") as fh:
-            self.dump(fh)
-
-    def flush(self):
-        if not self.modified:
+        dumper = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+        empty = True
+        for entry in self if entries is None else entries:
+            # a block sequence can simply be written item by item
+            fh.write(yaml.dump([entry.to_structure(conceal)], Dumper=dumper))
+            empty = False
+        if empty:
+            fh.write("[]\n")
+
+    def dump_json(self, fh=sys.stdout, entries=None, conceal=True):
+        # same output as json.dumps(self.to_structure(), indent=4)
+        sep = "[\n"
+        for entry in self if entries is None else entries:
+            data = json.dumps(entry.to_structure(conceal), indent=4)
+            fh.write(sep + "    " + data.replace("\n", "\n    "))
+            sep = ",\n"
+        fh.write("[]\n" if sep == "[\n" else "\n]\n")
+
+    def dump_ndjson(self, fh=sys.stdout, entries=None, conceal=True):
+        for entry in self if entries is None else entries:
+            fh.write(json.dumps(entry.to_structure(conceal)) + "\n")
+
+    def to_file(self, path, snapshot=True):
+        if self._mmap is not None:
+            self.materialize()
+        layout = []
+        raw = self.dumps(layout).encode("utf-8")
+        # write to a temporary file and rename it over the original (or
+        # the symlink's target), so that a crash never leaves it truncated
+        target = os.path.realpath(path)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(target),
+                                        prefix=".accdb.")
+        try:
+            with os.fdopen(fd, "wb") as fh:
+                try:
+                    os.fchmod(fh.fileno(), os.stat(target).st_mode & 0o7777)
+                except FileNotFoundError:
+                    pass
+                fh.write(raw)
+                fh.flush()
+                os.fsync(fh.fileno())
+                st = os.fstat(fh.fileno())
+            os.replace(tmp_path, target)
+        except:
+            os.unlink(tmp_path)
+            raise
+        if path == self.path:
+            self._base = (st.st_ino, st.st_size, st.st_mtime_ns)
+        if snapshot:
+            # next to the path it is loaded by, like in _load()
+            Snapshot.store(self, st, raw, path, layout)
+
+    def flush(self, compact=False):
+        """
+        Store changes, either by appending them to the journal or by
+        rewriting the file. With compact, a non-empty journal is merged into
+        the file even if nothing else has changed.
+        """
+        journal = self._journal
+        if not self.modified and not (compact and journal and journal.size()):
             return
         if self.readonly:
             print("(Discarding changes, database read-only)",
@@ -437,11 +1561,322 @@ class Database(object):
             return
         if self.path is None:
             return
+        if journal is None and "journal" in self.flags:
+            journal = self._journal = Journal.open(self.path, create=True)
         #print("(Storing database)", file=sys.stderr)
-        self.to_file(self.path)
+        if journal is None:
+            self.to_file(self.path)
+        elif self.modified and "journal" in self.flags \
+             and not (compact or self._touched):
+            journal.append(self, self._changes)
+            if journal.size() > Journal.MAX_SIZE:
+                journal.compact(self, self._changes)
+        else:
+            journal.compact(self, self._changes)
         self.modified = False
+        self._changes = []
+        self._touched = False
+
+class Journal(object):
+    """
+    Append-only log of entries added or replaced since the database file was
+    last written, kept next to it and replayed on top of it when loading.
+    Used instead of rewriting the file if the database has the "journal" flag.
+
+    Each record is a line holding a CRC-32 and a JSON object with the entry in
+    storage form. Writers hold an exclusive flock() on the journal, readers a
+    shared one.
+    """
+
+    # merge into the database file once the journal grows beyond this
+    MAX_SIZE = 256 * 1024
+
+    def __init__(self, path, fh):
+        self.path = path
+        self.fh = fh
+        # end of the last record read or written by us
+        self.offset = 0
+
+    @classmethod
+    def path_for(self, path):
+        head, tail = os.path.split(path)
+        return os.path.join(head, ".%s.journal" % tail)
+
+    @staticmethod
+    def identify(path):
+        # the file is always replaced by a rename, so this changes on rewrite
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    @classmethod
+    def open(self, path, create=False):
+        path = self.path_for(path)
+        flags = os.O_RDWR | (os.O_CREAT if create else 0)
+        try:
+            fd = os.open(path, flags, 0o600)
+        except FileNotFoundError:
+            return None
+        return self(path, os.fdopen(fd, "r+b"))
+
+    @contextmanager
+    def locked(self, exclusive=False):
+        if fcntl is not None:
+            fcntl.flock(self.fh, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(self.fh, fcntl.LOCK_UN)
+
+    def size(self):
+        return os.fstat(self.fh.fileno()).st_size
+
+    def read(self):
+        """
+        Return records written since the last read, skipping damaged ones. An
+        incomplete record at the end (from an interrupted write) is left
+        alone, and self.offset points before it.
+        """
+        self.fh.seek(self.offset)
+        data = self.fh.read()
+        records = []
+        pos = 0
+        while True:
+            end = data.find(b"\n", pos)
+            if end < 0:
+                break
+            line = data[pos:end]
+            try:
+                crc, payload = line.split(b" ", 1)
+                if int(crc, 16) != zlib.crc32(payload):
+                    raise ValueError("checksum mismatch")
+                record = json.loads(payload.decode("utf-8"))
+                records.append((record["op"], record["entry"]))
+            except (ValueError, KeyError, TypeError) as e:
+                print("(Skipping damaged journal record at offset %d: %s)" \
+                    % (self.offset + pos, e),
+                    file=sys.stderr)
+            pos = end + 1
+        self.offset += pos
+        if pos < len(data) and debug:
+            trace("incomplete journal record at offset %d" % self.offset)
+        return records
+
+    def replay(self, db, skip=()):
+        """
+        Apply new records to db (except for entries whose UUIDs are in skip)
+        without recording them as changes again.
+        """
+        changes, db._changes = db._changes, None
+        count = 0
+        try:
+            for op, data in self.read():
+                entry = Entry.parse(data)
+                if entry.uuid in skip:
+                    continue
+                # records may be replayed twice if a compaction got
+                # interrupted, so an "add" can find its entry already there
+                if entry.uuid in db:
+                    db.replace(entry, history=False)
+                else:
+                    db.add(entry)
+                count += 1
+        finally:
+            db._changes = changes
+        if debug and count:
+            trace("replayed %d journal records" % count)
+        return count
+
+    def catch_up(self, db, changes):
+        """
+        Pick up records written by other processes, with the exclusive lock
+        held. On conflicts, our changes win. If another process compacted the
+        journal since, its records are in the file now, so that is reloaded
+        and our changes are applied to it again.
+        """
+        skip = {entry.uuid for op, entry in changes}
+        if db._base == self.identify(db.path) and self.size() >= self.offset:
+            self.replay(db, skip=skip)
+            return
+        if debug:
+            trace("journal was compacted by another process, reloading")
+        db.reload()
+        self.offset = 0
+        self.replay(db, skip=skip)
+        saved, db._changes = db._changes, None
+        try:
+            for op, entry in changes:
+                if entry.uuid in db:
+                    db.replace(entry, history=False)
+                else:
+                    db.add(entry)
+        finally:
+            db._changes = saved
+
+    def append(self, db, changes):
+        conceal = ("conceal" in db.flags)
+        data = b""
+        for op, entry in changes:
+            payload = json.dumps({"op": op, "entry": entry.dump_stored(conceal)})
+            payload = payload.encode("utf-8")
+            data += b"%08x %s\n" % (zlib.crc32(payload), payload)
+        with self.locked(exclusive=True):
+            self.catch_up(db, changes)
+            # drops an incomplete record left by an interrupted write
+            self.fh.truncate(min(self.offset, self.size()))
+            self.fh.seek(self.offset)
+            self.fh.write(data)
+            self.fh.flush()
+            os.fsync(self.fh.fileno())
+            self.offset += len(data)
+
+    def compact(self, db, changes=()):
+        """Write db, including new records, to its file and empty the journal."""
+        with self.locked(exclusive=True):
+            self.catch_up(db, changes)
+            db.to_file(db.path)
+            self.fh.truncate(0)
+            os.fsync(self.fh.fileno())
+            self.offset = 0
+
+class Snapshot(object):
+    """
+    Binary cache of a parsed Database, stored next to the text file it was
+    parsed from and used instead of reparsing it as long as the file still
+    has the same size, mtime and contents.
+    """
+
+    VERSION = 3
+
+    # mtimes closer than this to the snapshot time may hide a later write
+    RACY_NS = 2 * 10**9
+
+    @classmethod
+    def path_for(self, path):
+        head, tail = os.path.split(path)
+        return os.path.join(head, ".%s.snapshot" % tail)
+
+    @classmethod
+    def load(self, db):
+        with gc_paused():
+            return self._load(db)
+
+    @classmethod
+    def _load(self, db):
+        try:
+            st = os.stat(db.path)
+            with open(self.path_for(db.path), "rb") as fh:
+                hlen, = struct.unpack("!I", fh.read(4))
+                version, size, mtime, digest, taken = \
+                    marshal.loads(fh.read(hlen))
+                if version != (self.VERSION, marshal.version) \
+                   or size != st.st_size:
+                    return False
+                if mtime != st.st_mtime_ns or taken - mtime < self.RACY_NS:
+                    with open(db.path, "rb") as dbfh:
+                        if hashlib.sha1(dbfh.read()).hexdigest() != digest:
+                            if debug:
+                                trace("snapshot is stale")
+                            return False
+                data = marshal.loads(fh.read())
+        except (OSError, EOFError, ValueError, TypeError, struct.error) as e:
+            if debug:
+                trace("could not load snapshot:", e)
+            return False
+
+        modeline, flags, count, items, index = data
+        db._modeline = modeline
+        db.flags = set(flags)
+        classes = {}
+        for (uuid_bytes, itemno, lineno, name, comment, tags,
+             deleted, broken, attrs, stored) in items:
+            entry = Entry()
+            entry.uuid = uuid.UUID(bytes=uuid_bytes)
+            entry.itemno = itemno
+            entry.lineno = lineno
+            entry.name = name
+            entry.comment = comment
+            entry.tags = set(tags)
+            entry.deleted = deleted
+            entry._broken = broken
+            entry._stored = stored
+            for key, values in attrs:
+                key = sys.intern(key)
+                if key not in classes:
+                    classes[key] = PrivateAttribute if entry.is_private_attr(key) \
+                                   else Attribute
+                entry.attributes[key] = list(map(classes[key], values))
+            db.entries[entry.uuid] = entry
+            db.order.append(entry.uuid)
+            db.itemnos[entry.itemno] = entry.uuid
+            if entry.itemno != len(db.order):
+                # stored after a sort()
+                db.sorted = True
+        db.count = count
+        if index:
+            db._index = Index.from_structure(index)
+        return True
+
+    @classmethod
+    def store(self, db, st, raw, path=None, layout=None):
+        with gc_paused():
+            return self._store(db, st, raw, path, layout)
+
+    @classmethod
+    def _store(self, db, st, raw, path=None, layout=None):
+        # After a save, the layout of the text just written (see dumps())
+        # gives the item and line numbers that parsing it would: without
+        # deleted entries, and in file order even after a sort().
+        if layout is None:
+            layout = [(entry, entry.lineno) for entry in db]
+            renumbered = False
+        else:
+            renumbered = any(entry.itemno != itemno
+                             for itemno, (entry, _) in enumerate(layout, 1)) \
+                         or len(layout) != db.count
+        items = [(entry.uuid.bytes, (itemno if renumbered else entry.itemno),
+                  lineno, entry.name, entry.comment, list(entry.tags),
+                  entry.deleted, entry._broken,
+                  [(k, [v.dump() for v in vs])
+                   for k, vs in entry.attributes.items()],
+                  entry._stored)
+                 for itemno, (entry, lineno) in enumerate(layout, 1)]
+        header = ((self.VERSION, marshal.version), st.st_size, st.st_mtime_ns,
+                  hashlib.sha1(raw).hexdigest(), time.time_ns())
+        # the trigram index is the expensive one to build, so it's kept
+        # along with the rest of the indexes if enabled (and if its item
+        # numbers are still the right ones)
+        if "trigrams" in db.flags and not renumbered:
+            index = db.index.to_structure()
+        else:
+            index = None
+        data = (db._modeline, list(db.flags), len(layout), items, index)
+        snap_path = self.path_for(path or db.path)
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(snap_path) or ".",
+                                            prefix=".accdb.")
+        except OSError as e:
+            if debug:
+                trace("could not store snapshot:", e)
+            return
+        try:
+            header = marshal.dumps(header)
+            with os.fdopen(fd, "wb") as fh:
+                fh.write(struct.pack("!I", len(header)))
+                fh.write(header)
+                fh.write(marshal.dumps(data))
+            os.replace(tmp_path, snap_path)
+        except:
+            os.unlink(tmp_path)
+            raise
 
 class Entry(object):
+    __slots__ = ("attributes", "comment", "deleted", "itemno", "lineno",
+                 "name", "tags", "uuid", "_broken", "_stored")
+
     RE_TAGS = re.compile(r'\s*,\s*|\s+')
     RE_KEYVAL = re.compile(r'=|: ')
 
@@ -457,6 +1892,7 @@ class Entry(object):
         self.tags = set()
         self.uuid = None
         self._broken = False
+        self._stored = None
 
     # Import
 
@@ -466,32 +1902,40 @@ class Entry(object):
 
     def parseinto(self, data, lineno=1):
         # lineno is passed here for use in syntax error messages
+        return self.parselines(enumerate(data.splitlines(), lineno), lineno)
+
+    def parselines(self, lines, lineno=1):
+        """
+        Parse an entry from (lineno, line) pairs, as produced by
+        split_records(), with line terminators already removed.
+        """
         self.lineno = lineno
 
-        for line in data.splitlines():
+        for lineno, line in lines:
             line = line.lstrip()
             if not line:
-                pass
-            elif line.startswith("="):
+                continue
+            char = line[0]
+            if char == "=":
                 if self.name:
                     # Ensure that Database only passes us single entries
                     print("Line %d: ignoring multiple name headers" \
                         % lineno,
                         file=sys.stderr)
                 self.name = line[1:].strip()
-            elif line.startswith("+"):
+            elif char == "+":
                 self.tags |= split_tags(line[1:])
                 if "\\deleted" in self.tags:
                     self.deleted = True
-            elif line.startswith(";"):
+            elif char == ";":
                 self.comment += line[1:] + "\n"
-            elif line.startswith("(") and line.endswith(")"):
+            elif char == "(" and line.endswith(")"):
                 # annotations in search output
                 pass
-            elif line.startswith("█") and line.endswith("█"):
+            elif char == "█" and line.endswith("█"):
                 # QR code
                 pass
-            elif line.startswith("{") and line.endswith("}"):
+            elif char == "{" and line.endswith("}"):
                 if self.uuid:
                     print("Line %d: ignoring multiple UUID headers" \
                         % lineno,
@@ -506,7 +1950,7 @@ class Entry(object):
                     self.comment += line + "\n"
             else:
                 try:
-                    key, val = re.split(self.RE_KEYVAL, line, 1)
+                    key, val = self.RE_KEYVAL.split(line, 1)
                 except ValueError:
                     print("Line %d: could not parse line %r" \
                         % (lineno, line),
@@ -531,7 +1975,7 @@ class Entry(object):
                 elif key.startswith("date.") and val in {"now", "today"}:
                     val = time.strftime("%Y-%m-%d")
 
-                key = translate_field(key)
+                key = sys.intern(translate_field(key))
 
                 if self.is_private_attr(key):
                     attr = PrivateAttribute(val)
@@ -543,8 +1987,6 @@ class Entry(object):
                 else:
                     self.attributes[key] = [attr]
 
-            lineno += 1
-
         if not self.name:
             self.name = "(Unnamed)"
 
@@ -553,6 +1995,14 @@ class Entry(object):
     def is_private_attr(self, key):
         return key == "pass" or key.startswith("!")
 
+    def same_as(self, other):
+        """Check whether both entries would be stored identically."""
+        return self.uuid == other.uuid \
+           and self.name == other.name \
+           and self.comment == other.comment \
+           and self.tags == other.tags \
+           and self.attributes == other.attributes
+
     # Export
 
     def dump(self, storage=False, terse=False, conceal=True):
@@ -570,53 +2020,74 @@ class Entry(object):
         if storage:
             terse = False
 
-        data = ""
+        data = []
+        add = data.append
 
         if not storage:
             if self.itemno:
-                data += "(item %d)\n" % self.itemno
+                add("(item %d)\n" % self.itemno)
             elif self.lineno:
-                data += "(line %d)\n" % self.lineno
+                add("(line %d)\n" % self.lineno)
 
-        data += "= %s\n" % self.name
+        add("= %s\n" % self.name)
 
         for line in self.comment.splitlines():
-            data += ";%s\n" % line
+            add(";%s\n" % line)
 
         if self.uuid and storage:
-            data += "\t{%s}\n" % self.uuid
+            add("\t{%s}\n" % self.uuid)
 
         for key in sort_fields(self, terse):
+            encode = storage and conceal and self.is_private_attr(key)
             for value in self.attributes[key]:
                 if storage or not conceal:
                     value = value.dump()
-                if storage and conceal and self.is_private_attr(key) \
-                    and not value.startswith("<base64> "):
-                    value = value.encode("utf-8")
-                    value = b64encode(value)
-                    value = value.decode("utf-8")
+                if encode and not value.startswith("<base64> "):
+                    value = b64encode(value.encode("utf-8")).decode("utf-8")
                     value = "<base64> %s" % value
-                data += "\t%s: %s\n" % (key, value)
+                add("\t%s: %s\n" % (key, value))
 
         if self.tags:
-            tags = list(self.tags)
-            tags.sort()
+            # wrap tag lines at 80 columns (with 8-column tabs)
             line = []
-            while tags or line:
-                linelen = 8 + sum([len(i) + 2 for i in line])
-                if not tags or (line and linelen + len(tags[0]) + 2 > 80):
-                    data += "\t+ %s\n" % ", ".join(line)
+            linelen = 8
+            for tag in sorted(self.tags):
+                if line and linelen + len(tag) + 2 > 80:
+                    add("\t+ %s\n" % ", ".join(line))
                     line = []
-                if tags:
-                    line.append(tags.pop(0))
+                    linelen = 8
+                line.append(tag)
+                linelen += len(tag) + 2
+            add("\t+ %s\n" % ", ".join(line))
 
-        return data
+        return "".join(data)
+
+    def dump_stored(self, conceal=True):
+        """
+        Storage form of the entry, kept until the entry is changed through
+        Database.add() or replace(), or invalidated using touch().
+        """
+        if self._stored is None or self._stored[0] != conceal:
+            self._stored = (conceal, self.dump(storage=True, conceal=conceal))
+        return self._stored[1]
+
+    def touch(self):
+        self._stored = None
+
+    def to_structure(self, conceal=True):
+        """
+        conceal
+            replace private values with a placeholder
+        """
+        def dump(key, val):
+            if conceal and self.is_private_attr(key):
+                return str(val)
+            return val.dump()
 
-    def to_structure(self):
         dis = dict()
         dis["name"] = self.name
         dis["comment"] = self.comment
-        dis["data"] = {key: list(val.dump() for val in self.attributes[key])
+        dis["data"] = {key: [dump(key, val) for val in self.attributes[key]]
                 for key in sort_fields(self, False)}
         dis["lineno"] = self.lineno
         dis["tags"] = list(self.tags)
@@ -632,12 +2103,58 @@ class Entry(object):
 
     @property
     def normalized_name(self):
-        return re.search(self.RE_COLL, self.name).group(0).lower()
+        match = self.RE_COLL.search(self.name)
+        # names without any letters or digits sort as they are
+        return (match.group(0) if match else self.name).lower()
+
+class LazyEntry(Entry):
+    """
+    An entry whose body is only parsed when its attributes, tags or comments
+    are first accessed. Until then it knows only its name, UUID and line
+    number, plus the ranges of the database buffer holding its text.
+    """
+
+    _lazy_attrs = {"attributes", "comment", "deleted", "tags", "_broken"}
+
+    def __init__(self, buf, name, lineno):
+        self.__dict__.update(_buf=buf, _segments=None, _eager=(not name))
+        self.itemno = None
+        self.lineno = lineno
+        self.name = name
+        self.uuid = None
+        self._stored = None
+
+    def materialize(self):
+        segments = self.__dict__.pop("_segments", None)
+        if segments is None:
+            return
+        data = b"".join(self._buf[a:b] for a, b in segments)
+        itemno, lineno, uuid = self.itemno, self.lineno, self.uuid
+        Entry.__init__(self)
+        self.parseinto(data.decode("utf-8"), lineno=lineno)
+        self.itemno = itemno
+        if self.uuid is None:
+            # one assigned by Database.add()
+            self.uuid = uuid
+        del self._buf
+
+    def __getattr__(self, name):
+        if name in self._lazy_attrs and "_segments" in self.__dict__:
+            self.materialize()
+            return getattr(self, name)
+        raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        if name in self._lazy_attrs and "_segments" in self.__dict__:
+            self.materialize()
+        object.__setattr__(self, name, value)
 
 class Attribute(str):
     # Nothing special about this class. Exists only for consistency
     # with PrivateAttribute providing a dump() method.
 
+    __slots__ = ()
+
     def dump(self):
         return str.__str__(self)
 
@@ -645,6 +2162,8 @@ class PrivateAttribute(Attribute):
     # Safeguard class to prevent accidential disclosure of private values.
     # Inherits a dump() method from Attribute for obtaining the actual data.
 
+    __slots__ = ()
+
     def __repr__(self):
         if self == "<private[data lost]>":
             return self.dump()
@@ -655,9 +2174,80 @@ class PrivateAttribute(Attribute):
             return self.dump()
         return "<private[%d]>" % len(self)
 
+class HashList(object):
+    """
+    A sorted list of SHA-1 hashes, one "HASH:COUNT" per line, such as the
+    "ordered by hash" Pwned Passwords download. The file is mmap'd and
+    binary-searched rather than read.
+    """
+
+    # ranges smaller than this are searched with a single find()
+    WINDOW = 1 << 16
+
+    def __init__(self, path):
+        with open(path, "rb") as fh:
+            self.buf = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        self.lower = self.buf[:40].islower()
+
+    def close(self):
+        self.buf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _line(self, pos):
+        """Return the start and hash of the first line at or after pos."""
+        buf = self.buf
+        if pos > 0:
+            pos = buf.find(b"\n", pos - 1) + 1 or len(buf)
+        return pos, buf[pos:pos+40]
+
+    def lookup(self, digest):
+        """Return the count listed for a hex digest, or 0 if not found."""
+        buf = self.buf
+        target = (digest.lower() if self.lower else digest.upper())
+        target = target.encode("ascii")
+        lo, hi = 0, len(buf)
+
+        # the hashes are uniformly distributed, so the position can be
+        # guessed; the guess is only used if it's confirmed by its neighbours
+        guess = int(target[:8], 16) * hi >> 32
+        start, key = self._line(max(lo, guess - self.WINDOW))
+        if key and key <= target:
+            lo = start
+        start, key = self._line(min(hi, guess + self.WINDOW))
+        if key > target or not key:
+            hi = start
+
+        while hi - lo > self.WINDOW:
+            start, key = self._line((lo + hi) // 2)
+            if start >= hi:
+                break
+            elif key <= target:
+                lo = start
+            else:
+                hi = start
+
+        # a full hash can only match at the start of a line
+        pos = buf.find(target, lo, min(len(buf), hi + len(target)))
+        if pos < 0:
+            return 0
+        end = buf.find(b"\n", pos)
+        if end < 0:
+            # last line, without a newline
+            end = len(buf)
+        try:
+            return int(buf[pos+len(target)+1:end].strip() or 1)
+        except ValueError:
+            return 1
+
 class Interactive(cmd.Cmd):
     def __init__(self, *args, **kwargs):
         cmd.Cmd.__init__(self, *args, **kwargs)
+        self.clipboard = Clipboard
         self.prompt = "\001\033[34m\002" "accdb>" "\001\033[m\002" " "
         self.banner = "Using %s" % db_path
 
@@ -685,23 +2275,31 @@ class Interactive(cmd.Cmd):
         entry = db.find_by_itemno(arg)
         print(entry)
         if "pass" in entry.attributes:
-            Clipboard.put(entry.attributes["pass"][0].dump())
+            self.clipboard.put(entry.attributes["pass"][0].dump())
         else:
             print("No password found!",
                 file=sys.stderr)
 
     def do_dump(self, arg, db=None):
-        """Dump the database to stdout (yaml, json, safe)"""
+        """Dump the database to stdout (yaml, json, ndjson [-r] [filter], safe)"""
         if db is None:
             db = globals()["db"]
 
-        if arg == "":
+        args = shlex.split(arg)
+        format = args.pop(0) if args else ""
+        reveal = bool(args) and args[0] in {"-r", "--reveal"}
+        if reveal:
+            args.pop(0)
+        entries = db.find(self.parse_filter(args)[1]) if args else None
+        exporters = {"yaml": db.dump_yaml,
+                     "json": db.dump_json,
+                     "ndjson": db.dump_ndjson}
+
+        if format == "" and not args:
             db.dump()
-        elif arg == "yaml":
-            db.dump_yaml()
-        elif arg == "json":
-            db.dump_json()
-        elif arg == "safe":
+        elif format in exporters:
+            exporters[format](entries=entries, conceal=(not reveal))
+        elif format == "safe" and not args:
             db.dump(storage=False)
         else:
             print("Unsupported export format: %r" % arg,
@@ -709,7 +2307,7 @@ class Interactive(cmd.Cmd):
 
     def do_edit(self, arg):
         """Launch an editor"""
-        db.flush()
+        db.flush(compact=True)
         db.modified = False
         start_editor(db_path)
         return True
@@ -728,7 +2326,33 @@ class Interactive(cmd.Cmd):
         if full and not sys.stdout.isatty():
             print(db._modeline)
 
-        args = shlex.split(arg)
+        arg, filter = self.parse_filter(shlex.split(arg))
+
+        results = db.find_cached(filter)
+
+        num = 0
+        with profiler.phase("output"):
+            for entry in results:
+                if entry.deleted:
+                    continue
+                if full:
+                    print(entry.dump(storage=True, conceal=False))
+                elif ls:
+                    print("%5d │ %s" % (entry.itemno, entry.name))
+                else:
+                    print(entry)
+                num += 1
+        profiler.count("output", num)
+
+        if sys.stdout.isatty():
+            print("(%d %s matching '%s')" % \
+                (num, ("entry" if num == 1 else "entries"), filter))
+
+    def parse_filter(self, args):
+        with profiler.phase("compile"):
+            return self._parse_filter(args)
+
+    def _parse_filter(self, args):
         try:
             if len(args) > 1:
                 arg = "AND"
@@ -749,23 +2373,7 @@ class Interactive(cmd.Cmd):
         if debug:
             trace("compiled filter:", filter)
 
-        results = db.find(filter)
-
-        num = 0
-        for entry in results:
-            if entry.deleted:
-                continue
-            if full:
-                print(entry.dump(storage=True, conceal=False))
-            elif ls:
-                print("%5d │ %s" % (entry.itemno, entry.name))
-            else:
-                print(entry)
-            num += 1
-
-        if sys.stdout.isatty():
-            print("(%d %s matching '%s')" % \
-                (num, ("entry" if num == 1 else "entries"), filter))
+        return arg, filter
 
     def do_convert(self, arg):
         """Read entries from stdin and dump to stdout"""
@@ -780,23 +2388,19 @@ class Interactive(cmd.Cmd):
         newdb = Database()
         newdb.parseinto(sys.stdin)
 
-        outdb = Database()
+        report = db.merge(newdb)
 
-        for newentry in newdb:
-            if newentry._broken:
-                print("(warning: skipped broken entry)", file=sys.stderr)
-                print(newentry.dump(storage=True), file=sys.stderr)
-                continue
+        for entry in report["broken"]:
+            print("(warning: skipped broken entry)", file=sys.stderr)
+            print(entry.dump(storage=True), file=sys.stderr)
 
-            try:
-                entry = db.replace(newentry)
-            except KeyError:
-                entry = db.add(newentry)
-            outdb.add(entry)
+        for kind, mark in [("new", "+"), ("changed", "~")]:
+            for entry in report[kind]:
+                print("%s %5d │ %s" % (mark, entry.itemno, entry.name))
 
-            db.modified = True
-
-        self.do_dump("", outdb)
+        print("(%d new, %d changed, %d identical, %d broken)" % \
+            tuple(len(report[kind])
+                  for kind in ["new", "changed", "identical", "broken"]))
 
     def do_reveal(self, arg):
         """Display entry (including sensitive information)"""
@@ -828,13 +2432,100 @@ class Interactive(cmd.Cmd):
                         print("\t" + line.decode("utf-8"), end="")
                 print()
 
+    def do_agent(self, arg):
+        """Keep the database loaded and answer queries from other accdb's"""
+        Agent(db_path).serve()
+        return True
+
+    def do_audit(self, arg):
+        """Find reused passwords, and breached ones using a hash list"""
+        path = arg or os.environ.get("ACCDB_PWNED")
+
+        groups = defaultdict(list)
+        for entry in db:
+            if entry.deleted:
+                continue
+            for value in entry.attributes.get("pass", []):
+                value = value.dump()
+                if value == "<private[data lost]>":
+                    continue
+                digest = hashlib.sha1(value.encode("utf-8")).hexdigest()
+                if entry not in groups[digest]:
+                    groups[digest].append(entry)
+
+        if path:
+            try:
+                hashes = HashList(path)
+            except (OSError, ValueError) as e:
+                print("Cannot open hash list %r: %s" % (path, e),
+                    file=sys.stderr)
+                return
+            breached = []
+            with hashes:
+                for digest, entries in groups.items():
+                    count = hashes.lookup(digest)
+                    if count:
+                        breached += [(entry, count) for entry in entries]
+            breached.sort(key=lambda item: item[0].itemno)
+            print("(%d %s with breached passwords)" % \
+                (len(breached), ("entry" if len(breached) == 1 else "entries")))
+            for entry, count in breached:
+                print("%5d │ %s (seen %d times)" % (entry.itemno, entry.name,
+                                                   count))
+        elif sys.stderr.isatty():
+            print("(No hash list given, only checking for reuse.)",
+                file=sys.stderr)
+
+        reused = [entries for entries in groups.values() if len(entries) > 1]
+        reused.sort(key=lambda entries: (-len(entries), entries[0].itemno))
+        print("(%d %s shared by several entries)" % \
+            (len(reused), ("password" if len(reused) == 1 else "passwords")))
+        for num, entries in enumerate(reused, 1):
+            for entry in entries:
+                print("%5d │ %s [reuse group %d]" % (entry.itemno, entry.name,
+                                                    num))
+
+    def do_fuzzy(self, arg):
+        """Search for entries with names similar to the argument [-n N]"""
+        args = shlex.split(arg)
+        limit = 10
+        if len(args) > 1 and args[0] == "-n":
+            limit = int(args[1])
+            args = args[2:]
+        query = " ".join(args)
+        if not query:
+            print("Nothing to search for.", file=sys.stderr)
+            return
+
+        for score, itemno in db.names.search(query, limit):
+            entry = db.find_by_itemno(itemno)
+            print("%5d │ %s (%d%%)" % (entry.itemno, entry.name, score * 100))
+
+    def do_dupes(self, arg):
+        """List entries which look like duplicates (same host and login)"""
+        groups = db.duplicates()
+        for keys, entries in groups:
+            print("%s:" % ", ".join(obj if ident is None else
+                                    "%s (%s)" % (obj, ident)
+                                    for obj, ident in keys))
+            for entry in entries:
+                print("%5d │ %s" % (entry.itemno, entry.name))
+        print("(%d %s of possible duplicates)" % \
+            (len(groups), ("group" if len(groups) == 1 else "groups")))
+
+    def do_compact(self, arg):
+        """Merge the change journal into the accounts.db file"""
+        db.flush(compact=True)
+
     def do_touch(self, arg):
         """Rewrite the accounts.db file"""
+        db.touch()
         db.modified = True
 
     def do_sort(self, arg):
         """Sort and rewrite the database"""
         db.sort()
+        db.touch()
         db.modified = True
 
     def do_lstags(self, arg):
@@ -879,28 +2570,311 @@ class Clipboard():
         else:
             raise RuntimeError("Unsupported platform")
 
+class Watcher(object):
+    """
+    Notices changes to the database file or its journal, using inotify where
+    available (through ctypes) and comparing stat() results otherwise.
+    """
+
+    IN_MODIFY       = 0x002
+    IN_CLOSE_WRITE  = 0x008
+    IN_MOVED_TO     = 0x080
+    IN_CREATE       = 0x100
+    IN_DELETE       = 0x200
+
+    def __init__(self, path):
+        self.paths = [path, Journal.path_for(path)]
+        self.fd = None
+        self.stats = self._stats()
+        # saves are renamed into place next to a symlink's target, not the link
+        target = os.path.realpath(path)
+        dirs = {os.path.dirname(path) or ".", os.path.dirname(target)}
+        if sys.platform.startswith("linux"):
+            try:
+                self.fd = self._inotify(dirs, self.paths + [target])
+            except OSError as e:
+                if debug:
+                    trace("inotify not available, polling instead:", e)
+
+    def _inotify(self, dirs, paths):
+        import ctypes, ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        mask = self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_TO \
+               | self.IN_CREATE | self.IN_DELETE
+        for dir in dirs:
+            if libc.inotify_add_watch(fd, os.fsencode(dir), mask) < 0:
+                errno = ctypes.get_errno()
+                os.close(fd)
+                raise OSError(errno, "inotify_add_watch failed")
+        self.names = {os.fsencode(os.path.basename(p)) for p in paths}
+        return fd
+
+    def _stats(self):
+        stats = []
+        for path in self.paths:
+            try:
+                st = os.stat(path)
+                stats.append((st.st_ino, st.st_size, st.st_mtime_ns))
+            except FileNotFoundError:
+                stats.append(None)
+        return stats
+
+    def changed(self):
+        if self.fd is None:
+            stats = self._stats()
+            changed, self.stats = (stats != self.stats), stats
+            return changed
+        changed = False
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+            except BlockingIOError:
+                if changed:
+                    self.stats = self._stats()
+                return changed
+            pos = 0
+            while pos < len(buf):
+                # struct inotify_event { int wd; u32 mask, cookie, len; name }
+                wd, mask, cookie, size = struct.unpack_from("iIII", buf, pos)
+                name = buf[pos+16:pos+16+size].rstrip(b"\0")
+                changed = changed or name in self.names
+                pos += 16 + size
+
+class Agent(object):
+    """
+    Serves read-only commands for one database over a Unix socket, so that
+    repeated accdb invocations needn't load it each time. The database is
+    reloaded when the file changes, or brought up to date from the journal
+    if only that has grown.
+    """
+
+    commands = {"c", "copy", "fuzzy", "g", "grep", "ls", "re", "reveal", "s",
+                "show"}
+
+    # seconds a client may take to send its request or read the reply
+    TIMEOUT = 5
+
+    def __init__(self, path):
+        self.path = path
+        self.sock_path = self.path_for(path)
+
+    @classmethod
+    def path_for(self, path):
+        # one agent per database, in a directory only we can access
+        dir = os.environ.get("XDG_RUNTIME_DIR")
+        if not dir:
+            dir = os.path.join(tempfile.gettempdir(), "accdb-%d" % os.getuid())
+            os.makedirs(dir, mode=0o700, exist_ok=True)
+            st = os.lstat(dir)
+            if st.st_uid != os.getuid() or st.st_mode & 0o077:
+                raise PermissionError("insecure agent directory %r" % dir)
+        key = hashlib.sha1(os.fsencode(os.path.realpath(path))).hexdigest()
+        return os.path.join(dir, "accdb-%s.sock" % key[:16])
+
+    @classmethod
+    def check_peer(self, conn):
+        if hasattr(socket, "SO_PEERCRED"):
+            creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                    struct.calcsize("3i"))
+            pid, uid, gid = struct.unpack("3i", creds)
+            return uid == os.getuid()
+        return True
+
+    @classmethod
+    def call(self, path, args, isatty=False):
+        """
+        Run a command through the agent and return its exit status, or None
+        if there is no agent to talk to.
+        """
+        if args[0] not in self.commands:
+            return None
+        try:
+            sock_path = self.path_for(path)
+            conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            conn.connect(sock_path)
+        except OSError:
+            return None
+        with conn:
+            request = {"args": args, "isatty": isatty}
+            conn.sendall(json.dumps(request).encode("utf-8"))
+            conn.shutdown(socket.SHUT_WR)
+            data = b""
+            while True:
+                buf = conn.recv(65536)
+                if not buf:
+                    break
+                data += buf
+        try:
+            reply = json.loads(data.decode("utf-8"))
+        except ValueError:
+            # agent went away mid-request
+            return None
+        sys.stdout.write(reply["stdout"])
+        sys.stderr.write(reply["stderr"])
+        if reply.get("clipboard") is not None:
+            Clipboard.put(reply["clipboard"])
+        return reply["status"]
+
+    def reload(self):
+        global db
+        journal = db._journal
+        try:
+            if journal is not None and self.watcher.stats[0] == self.base_stat \
+               and journal.size() >= journal.offset:
+                with journal.locked():
+                    count = journal.replay(db)
+                if debug:
+                    trace("agent: applied %d journal records" % count)
+            else:
+                db = Database.from_file(self.path)
+                if debug:
+                    trace("agent: reloaded database")
+        except Exception as e:
+            # e.g. the file is missing or half-edited; keep serving the last
+            # good copy, and try again on the next change
+            trace("agent: cannot reload database: %s: %s" % \
+                (type(e).__name__, e))
+            return
+        self.base_stat = self.watcher.stats[0]
+
+    def handle(self, conn):
+        # so that a stuck client cannot hold up the others
+        conn.settimeout(self.TIMEOUT)
+        data = b""
+        while True:
+            buf = conn.recv(65536)
+            if not buf:
+                break
+            data += buf
+        request = json.loads(data.decode("utf-8"))
+        args = request["args"]
+        if args[0] not in self.commands:
+            raise ValueError("command %r not allowed" % args[0])
+
+        class Output(io.StringIO):
+            def isatty(self):
+                return request["isatty"]
+
+        class Capture(object):
+            data = None
+            @classmethod
+            def put(self, data):
+                self.data = data
+
+        interp = Interactive()
+        interp.clipboard = Capture
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = Output(), io.StringIO()
+        try:
+            interp.onecmd(subprocess.list2cmdline(args))
+            status = 0
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else 1
+        except Exception as e:
+            print("accdb agent: %s: %s" % (type(e).__name__, e), file=sys.stderr)
+            status = 1
+        finally:
+            reply = {"stdout": sys.stdout.getvalue(),
+                     "stderr": sys.stderr.getvalue(),
+                     "status": status,
+                     "clipboard": Capture.data}
+            sys.stdout, sys.stderr = stdout, stderr
+        conn.sendall(json.dumps(reply).encode("utf-8"))
+
+    def serve(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            os.unlink(self.sock_path)
+        except FileNotFoundError:
+            pass
+        umask = os.umask(0o077)
+        try:
+            sock.bind(self.sock_path)
+        finally:
+            os.umask(umask)
+        sock.listen(16)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        self.watcher = Watcher(self.path)
+        self.base_stat = self.watcher.stats[0]
+        if sys.stderr.isatty():
+            print("(Agent listening on %s)" % self.sock_path, file=sys.stderr)
+        try:
+            while True:
+                fds = [sock] if self.watcher.fd is None \
+                      else [sock, self.watcher.fd]
+                ready, _, _ = select.select(fds, [], [])
+                if self.watcher.changed():
+                    self.reload()
+                if sock in ready:
+                    conn, _ = sock.accept()
+                    with conn:
+                        if not self.check_peer(conn):
+                            continue
+                        try:
+                            self.handle(conn)
+                        except (OSError, ValueError, KeyError) as e:
+                            trace("agent: bad request:", e)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            sock.close()
+            os.unlink(self.sock_path)
+
 db_path = os.environ.get("ACCDB",
             os.path.expanduser("~/accounts.db.txt"))
 
 db_cache_path = os.path.expanduser("~/Private/accounts.cache.txt")
 
-if os.path.exists(db_path):
-    db = Database.from_file(db_path)
-else:
-    db = Database.from_file(db_cache_path)
-    db.readonly = True
-    if sys.stderr.isatty():
-        print("(Using read-only cache.)", file=sys.stderr)
+# commands that only look at a few entries by item number, and don't modify
+# the database, so it can be loaded lazily (item numbers then come from the
+# text, which snapshots are kept consistent with; see Snapshot._store)
+lazy_commands = {"c", "copy", "qr", "re", "reveal", "s", "show"}
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--profile":
+        del sys.argv[1]
+        profiler.configure("1")
 
-interp = Interactive()
+    profiler.start()
 
-if len(sys.argv) > 1:
-    line = subprocess.list2cmdline(sys.argv[1:])
-    interp.onecmd(line)
-else:
-    interp.cmdloop()
+    if len(sys.argv) > 1 and not (debug or profiler.enabled):
+        status = Agent.call(db_path, sys.argv[1:], sys.stdout.isatty())
+        if status is not None:
+            sys.exit(status)
 
-db.flush()
+    lazy = len(sys.argv) > 1 and sys.argv[1] in lazy_commands
 
-if "cache" in db.flags and db.path != db_cache_path:
-    db.to_file(db_cache_path)
+    with profiler.phase("load"):
+        if os.path.exists(db_path):
+            db = Database.from_file(db_path, lazy=lazy)
+        else:
+            db = Database.from_file(db_cache_path, readonly=True, lazy=lazy)
+            if sys.stderr.isatty():
+                print("(Using read-only cache.)", file=sys.stderr)
+    profiler.count("load", db.count)
+
+    interp = Interactive()
+
+    try:
+        with profiler.phase("command"):
+            if len(sys.argv) > 1:
+                line = subprocess.list2cmdline(sys.argv[1:])
+                interp.onecmd(line)
+            else:
+                interp.cmdloop()
+
+        with profiler.phase("flush"):
+            db.flush()
+
+        if "cache" in db.flags and db.path != db_cache_path:
+            with profiler.phase("cache"):
+                if lazy and not db.journaled:
+                    # nothing could have changed, the file is still up to date
+                    shutil.copyfile(db.path, db_cache_path)
+                else:
+                    db.to_file(db_cache_path)
+    finally:
+        profiler.report()
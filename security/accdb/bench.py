@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+# bench - timing harness for accdb using synthetic databases
+
+from __future__ import print_function
+import io
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import accdb
+
+accdb_path = accdb.__file__
+
+words = ("alpha bravo charlie delta echo foxtrot golf hotel india juliet kilo"
+         " lima mike november oscar papa quebec romeo sierra tango uniform"
+         " victor whiskey xray yankee zulu").split()
+
+domains = ["com", "net", "org", "eu", "lt", "io"]
+
+def synth_entry(rng, i, attrs=4, tags=3, private=1):
+    name = "%s %s %d" % (rng.choice(words).title(), rng.choice(words), i)
+    host = "%s.%s.%s" % (rng.choice(words), rng.choice(words), rng.choice(domains))
+    lines = ["= %s" % name,
+             "\t{%s}" % uuid.UUID(int=rng.getrandbits(128), version=4),
+             "\thost: %s" % host,
+             "\tlogin: %s%d" % (rng.choice(words), rng.randint(1, 999))]
+    for j in range(attrs):
+        lines.append("\t%s.%s: %s %d" % (rng.choice(words), rng.choice(words),
+                                         rng.choice(words), rng.randint(1, 9999)))
+    for j in range(private):
+        key = "pass" if j == 0 else "!%s" % rng.choice(words)
+        lines.append("\t%s: %x" % (key, rng.getrandbits(64)))
+    if tags:
+        lines.append("\t+ %s" % ", ".join(sorted({"is:%s" % rng.choice(words)
+                                                  for j in range(tags)})))
+    return "\n".join(lines) + "\n"
+
+def synth_database(path, count, seed=0, **kwargs):
+    rng = random.Random(seed)
+    with open(path, "w", encoding="utf-8", newline="\n") as fh:
+        print("; vim: ft=accdb:", file=fh)
+        for i in range(count):
+            print(synth_entry(rng, i, **kwargs), file=fh)
+
+def best_of(runs, func, *args):
+    best = None
+    for i in range(runs):
+        t = time.perf_counter()
+        func(*args)
+        t = time.perf_counter() - t
+        best = t if best is None else min(best, t)
+    return best
+
+def run_accdb(db_path, *args):
+    env = dict(os.environ, ACCDB=db_path)
+    t = time.perf_counter()
+    subprocess.check_call([sys.executable, accdb_path] + list(args),
+                          env=env, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - t
+
+def bench_startup(db_path, runs=5):
+    """Time a one-shot lookup with and without a valid snapshot."""
+    snap_path = snapshot_path(db_path)
+    cold, warm = [], []
+    for i in range(runs):
+        if os.path.exists(snap_path):
+            os.unlink(snap_path)
+        # not "show", which loads lazily and never uses the snapshot
+        cold.append(run_accdb(db_path, "ls", "#1"))
+        warm.append(run_accdb(db_path, "ls", "#1"))
+    return {"cold": min(cold), "warm": min(warm)}
+
+def bench_parse(db_path, runs=5):
+    """Text parsing throughput, bypassing the snapshot."""
+    with open(db_path, "r", encoding="utf-8") as fh:
+        text = fh.read()
+    size = len(text.encode("utf-8"))
+    best = None
+    for i in range(runs):
+        t = time.perf_counter()
+        accdb.Database().parseinto(io.StringIO(text))
+        t = time.perf_counter() - t
+        best = t if best is None else min(best, t)
+    print("parse: %.1f MB/s" % (size / best / 1e6), file=sys.stderr)
+    return {"parse": best}
+
+def bench_save(db_path, runs=5):
+    """Saving after a one-entry change, with and without cached entries."""
+    db = accdb.Database.from_file(db_path)
+    results = {}
+    for key, full in [("incremental", False), ("full", True)]:
+        best = None
+        for i in range(runs):
+            entry = db.find_by_itemno(1 + i)
+            entry = accdb.Entry.parse(entry.dump(storage=True, conceal=False))
+            entry.comment += "changed %d\n" % i
+            db.replace(entry)
+            if full:
+                db.touch()
+            t = time.perf_counter()
+            db.to_file(db_path)
+            t = time.perf_counter() - t
+            best = t if best is None else min(best, t)
+        results[key] = best
+    return results
+
+class FirstByte(io.TextIOBase):
+    """Discards output, remembering when the first write happened."""
+
+    def __init__(self):
+        self.first = None
+
+    def write(self, data):
+        if self.first is None:
+            self.first = time.perf_counter()
+        return len(data)
+
+def bench_export(db_path, runs=5):
+    """Peak Python heap and time-to-first-byte of JSON export."""
+    db = accdb.Database.from_file(db_path, readonly=True)
+
+    def whole(fh):
+        fh.write(json.dumps(db.to_structure(), indent=4))
+
+    def streaming(fh):
+        db.dump_json(fh)
+
+    results = {}
+    for key, func in [("whole", whole), ("streaming", streaming)]:
+        ttfb, total = [], []
+        for i in range(runs):
+            fh = FirstByte()
+            t = time.perf_counter()
+            func(fh)
+            total.append(time.perf_counter() - t)
+            ttfb.append(fh.first - t)
+        results["%s first byte" % key] = min(ttfb)
+        results["%s total" % key] = min(total)
+        # tracing slows things down a lot, so it gets a run of its own
+        tracemalloc.start()
+        func(FirstByte())
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print("%-10s %-60s %8.2f MB" % ("export", "%s peak heap" % key,
+                                        peak / 1e6))
+    return results
+
+grep_queries = [
+    "kilo",
+    "+is:alpha",
+    "@host=*.net",
+    "@login~^zulu",
+    "AND +is:alpha (NOT @host=*.com)",
+]
+
+def bench_grep(db_path, runs=5):
+    """In-process searches, with the indexes already built."""
+    db = accdb.Database.from_file(db_path, readonly=True)
+    db.index
+    results = {}
+    for query in grep_queries:
+        filter = accdb.compile_filter(query)
+        results[query] = best_of(runs, lambda: list(db.find(filter)))
+    return results
+
+def bench_dump(db_path, runs=5):
+    """Serializing every entry to the storage format."""
+    db = accdb.Database.from_file(db_path, readonly=True)
+    def dump():
+        db.touch()
+        db.dumps()
+    return {"storage": best_of(runs, dump)}
+
+def bench_merge(db_path, runs=5):
+    """Merging changes to 1% of the entries, as "accdb merge" would."""
+    db = accdb.Database.from_file(db_path, readonly=True)
+    count = max(1, min(1000, db.count // 100))
+    text = "".join(entry.dump(storage=True, conceal=False)
+                       .replace("\tlogin: ", "\tlogin: new-")
+                   for entry in list(db)[:count])
+    best = None
+    for i in range(runs):
+        # a fresh copy each time, or later runs would find nothing to change
+        db = accdb.Database.from_file(db_path, readonly=True)
+        t = time.perf_counter()
+        result = db.merge(accdb.Database.parse(io.StringIO(text)))
+        t = time.perf_counter() - t
+        assert len(result["changed"]) == count
+        best = t if best is None else min(best, t)
+    return {"%d entries" % count: best}
+
+filter_queries = [
+    "+is:alpha",
+    "AND +is:alpha @host=*.net",
+    "OR #5 @login=zulu* ~^bra",
+    "AND (NOT +is:bravo) (OR @host=*.com @host=*.org) mike",
+]
+
+def bench_filter(db_path, runs=5):
+    """
+    Per-entry cost of walking the filter tree with test() vs. calling the
+    flattened predicate. Both share the compiled per-pattern functions, so
+    this is not a comparison with older versions; use -o and -c for that.
+    """
+    db = accdb.Database.from_file(db_path, readonly=True)
+    entries = list(db)
+    results = {}
+    for query in filter_queries:
+        filter = accdb.compile_filter(query)
+        for key, func in [("tree", filter.test),
+                          ("flat", filter.predicate)]:
+            best = None
+            for i in range(runs):
+                t = time.perf_counter()
+                for entry in entries:
+                    func(entry)
+                t = (time.perf_counter() - t) / len(entries)
+                best = t if best is None else min(best, t)
+            results["%s %r" % (key, query)] = best
+    return results
+
+scan_queries = [
+    "@login=*9*",
+    "@host~kilo\\.[a-z]+\\.net",
+]
+
+def bench_scan(db_path, runs=5):
+    """Memory per entry, and attribute value scans by entry vs. by column."""
+    with open(db_path, "r", encoding="utf-8") as fh:
+        text = fh.read()
+    tracemalloc.start()
+    db = accdb.Database().parseinto(io.StringIO(text))
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print("%-10s %-60s %8.0f B" % ("scan", "memory per entry", size / db.count))
+    entries = list(db)
+    results = {}
+    for query in scan_queries:
+        filter = accdb.compile_filter(query)
+        test = filter.predicate
+        results["entries %r" % query] = \
+            best_of(runs, lambda: [entry for entry in entries if test(entry)])
+        results["columns %r" % query] = \
+            best_of(runs, lambda: db.columns.lookup(query))
+    return results
+
+def snapshot_path(db_path):
+    return accdb.Snapshot.path_for(db_path)
+
+def report(name, results, previous=None):
+    for key, val in results.items():
+        if val < 0.001:
+            line = "%-10s %-60s %8.2f µs" % (name, key, val * 1e6)
+        else:
+            line = "%-10s %-60s %8.2f ms" % (name, key, val * 1e3)
+        if previous and previous.get(key):
+            line += "  (%+.0f%%)" % ((val / previous[key] - 1) * 100)
+        print(line)
+
+if __name__ == "__main__":
+    op = OptionParser(usage="%prog [options] [benchmark...]",
+        description="Benchmarks: startup, parse, grep, filter, scan, dump,"
+                    " merge, save, export. The default is parse, grep, dump, merge"
+                    " and save.")
+    op.add_option("-n", "--entries", dest="entries", default="40000",
+        help="number of entries in the synthetic database (comma-separated"
+             " list to run with several sizes, e.g. 1000,10000,1000000)")
+    op.add_option("-a", "--attrs", dest="attrs", type="int", default=4,
+        help="number of extra attributes per entry")
+    op.add_option("-t", "--tags", dest="tags", type="int", default=3,
+        help="number of tags per entry")
+    op.add_option("-p", "--private", dest="private", type="int", default=1,
+        help="number of private attributes per entry")
+    op.add_option("-r", "--runs", dest="runs", type="int", default=5,
+        help="repeat each measurement this many times")
+    op.add_option("-o", "--output", dest="output",
+        help="write results as JSON to this file")
+    op.add_option("-c", "--compare", dest="compare",
+        help="compare with results from an earlier --output file")
+    opts, args = op.parse_args()
+
+    params = {"attrs": opts.attrs, "tags": opts.tags, "private": opts.private}
+    sizes = [int(n) for n in opts.entries.split(",")]
+    names = args or ["parse", "grep", "dump", "merge", "save"]
+
+    previous = {}
+    if opts.compare:
+        with open(opts.compare, "r") as fh:
+            previous = json.load(fh)["results"]
+
+    all_results = {}
+    tmp_dir = tempfile.mkdtemp(prefix="accdb-bench.")
+    try:
+        for size in sizes:
+            print("== %d entries" % size)
+            db_path = os.path.join(tmp_dir, "accounts.%d.db.txt" % size)
+            synth_database(db_path, size, **params)
+            all_results[str(size)] = sized = {}
+            for name in names:
+                func = globals()["bench_%s" % name]
+                sized[name] = results = func(db_path, runs=opts.runs)
+                report(name, results, previous.get(str(size), {}).get(name))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    if opts.output:
+        with open(opts.output, "w") as fh:
+            json.dump({"python": sys.version,
+                       "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                       "params": params,
+                       "runs": opts.runs,
+                       "results": all_results}, fh, indent=4)
@@ -0,0 +1,393 @@
+#!/usr/bin/env python
+# tests - accdb behaviour checks: queries, loading, saving and merging
+from __future__ import print_function
+import contextlib
+import io
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import accdb
+
+accdb.debug = False
+
+db_text = """; vim: ft=accdb:
+= One
+\tlogin: one
+= Two
+\tlogin: two
+= Three
+\tlogin: three
+; dbflags: journal
+"""
+
+def make_text(count, flags=""):
+    """A database with a mix of names, tags and attributes to search."""
+    lines = ["; vim: ft=accdb:"]
+    for i in range(count):
+        lines.append("= %s %d" % (["Example", "mail.example.org", "Bank",
+                                   "= ***", "Ärzte"][i % 5], i))
+        if i % 4 == 0:
+            lines.append("; comment %d" % i)
+        lines.append("\t{%s}" % uuid.UUID(int=i + 1))
+        lines.append("\t+ %s" % ", ".join(["work", "home", "old"][:i % 3 + 1]))
+        lines.append("\tlogin: user%d" % (i % 7))
+        if i % 2:
+            lines.append("\temail: user%d@example.net" % i)
+        if i % 3:
+            lines.append("\tpass: secret%d" % i)
+        if i % 6 == 1:
+            lines.append("\turi: https://www.example.com/%d" % i)
+    if flags:
+        lines.append("; dbflags: %s" % flags)
+    return "\n".join(lines) + "\n"
+
+def change(db, itemno, login):
+    entry = db.find_by_itemno(itemno)
+    entry = accdb.Entry.parse(entry.dump(storage=True, conceal=False))
+    entry.attributes["login"] = [accdb.Attribute(login)]
+    db.replace(entry)
+    db.modified = True
+
+def delete(db, itemno):
+    entry = db.find_by_itemno(itemno)
+    entry = accdb.Entry.parse(entry.dump(storage=True, conceal=False))
+    entry.tags.add("\\deleted")
+    entry.deleted = True
+    db.replace(entry)
+    db.modified = True
+
+def logins(db):
+    return [str(entry.attributes["login"][0]) for entry in db]
+
+def items(db):
+    return sorted((entry.itemno, entry.lineno, entry.name, str(entry.uuid),
+                   sorted(entry.tags),
+                   sorted((key, [str(value) for value in values])
+                          for key, values in entry.attributes.items()))
+                  for entry in db)
+
+def loads(path):
+    """
+    The same file as loaded from its snapshot, lazily (as for "show") and
+    by parsing the text, in that order.
+    """
+    snapshot = accdb.Database.from_file(path)
+    lazy = accdb.Database.from_file(path, lazy=True)
+    os.unlink(accdb.Snapshot.path_for(path))
+    parsed = accdb.Database.from_file(path, readonly=True)
+    return snapshot, lazy, parsed
+
+def report(msg, ok, actual_output):
+    print("%s: %s -> %r" % (" OK " if ok else "FAIL", msg, actual_output))
+    return 0 if ok else 1
+
+def run_journal_test(dir):
+    # Each Database has its own journal handle and locks, as separate
+    # processes would. C compacts the journal between B's load and B's flush.
+    path = os.path.join(dir, "accounts.db.txt")
+    with open(path, "w") as fh:
+        fh.write(db_text)
+    wanted_output = ["one.a", "two.c", "three.b"]
+    failed = 0
+
+    a = accdb.Database.from_file(path)
+    change(a, 1, "one.a")
+    a.flush()
+    b = accdb.Database.from_file(path)
+    c = accdb.Database.from_file(path)
+    change(c, 2, "two.c")
+    c.flush(compact=True)
+    change(b, 3, "three.b")
+    stderr = io.StringIO()
+    with contextlib.redirect_stderr(stderr):
+        b.flush()
+        actual_output = logins(accdb.Database.from_file(path))
+    failed += report("append after compaction", actual_output == wanted_output
+                     and not stderr.getvalue(), actual_output)
+    failed += report("writer's own view", logins(b) == wanted_output, logins(b))
+
+    b.flush(compact=True)
+    actual_output = logins(accdb.Database.from_file(path))
+    failed += report("compaction after compaction",
+                     actual_output == wanted_output, actual_output)
+
+    print("Tests: %d passed, %d failed" % (3 - failed, failed))
+    return failed
+
+patterns = ["*", "#7", "Example", "mail.*", "~ample", "~^b", "Ärz",
+            "+work", "+o*", "@email", "@email=user1*", "@login~r[35]$",
+            "@pass=secret1*", "@pass~2", "@ur*", "@uri=*example.com*",
+            "NOT +old", "(AND Example +home)", "(OR ~bank @email=*9@*)",
+            "(AND (OR +old +home) (NOT @uri) @login~3)"]
+
+def run_planner_test():
+    # The query planner (indexes, columns) must find the same entries as
+    # testing every entry, with and without the trigram index.
+    failed = 0
+    tests = 0
+    for flags in ["", "trigrams"]:
+        db = accdb.Database.parse(io.StringIO(make_text(200, flags)))
+        for sort in [False, True]:
+            if sort:
+                db.sort()
+            actual_output = []
+            for pattern in patterns:
+                filter = accdb.compile_filter(pattern)
+                wanted_output = [entry.itemno for entry in db
+                                 if filter.test(entry)]
+                # twice, as columns are only built when first needed
+                for i in range(2):
+                    if [entry.itemno for entry in db.find(filter)] \
+                       != wanted_output:
+                        actual_output.append(pattern)
+                        break
+            failed += report("planner%s%s" % (" with " + flags if flags else "",
+                                               ", sorted" if sort else ""),
+                             not actual_output, actual_output)
+            tests += 1
+    print("Tests: %d passed, %d failed" % (tests - failed, failed))
+    return failed
+
+def run_load_test(dir):
+    # Loading a file from its snapshot, lazily or by parsing it must give
+    # the same entries, numbered the same way.
+    path = os.path.join(dir, "load.db.txt")
+    with open(path, "w") as fh:
+        fh.write(make_text(50, "trigrams"))
+    failed = 0
+
+    db = accdb.Database.from_file(path)
+    snapshot, lazy, parsed = loads(path)
+    filter = accdb.compile_filter("(AND ~ample @login=user1)")
+    failed += report("snapshot stored by parsing",
+                     items(snapshot) == items(parsed), len(snapshot.order))
+    failed += report("lazy load", items(lazy) == items(parsed),
+                     len(lazy.order))
+    failed += report("trigram index from the snapshot",
+                     snapshot._index is not None and
+                     [entry.itemno for entry in snapshot.find(filter)] ==
+                     [entry.itemno for entry in parsed.find(filter)],
+                     snapshot._index is not None)
+
+    change(db, 3, "changed")
+    db.flush()
+    snapshot, lazy, parsed = loads(path)
+    failed += report("snapshot stored on save",
+                     items(snapshot) == items(parsed),
+                     logins(snapshot)[:4])
+    failed += report("lazy load after save", items(lazy) == items(parsed),
+                     logins(lazy)[:4])
+
+    print("Tests: %d passed, %d failed" % (5 - failed, failed))
+    return failed
+
+def run_merge_test():
+    db = accdb.Database.parse(io.StringIO(db_text))
+    one, two, three = list(db)
+    text = "".join([
+        # identical
+        one.dump(storage=True, conceal=False),
+        # changed
+        two.dump(storage=True, conceal=False).replace("login: two",
+                                                      "login: two.b"),
+        # new
+        "= Four\n\tlogin: four\n",
+        # broken
+        "= Five\n\tpass: <private[data lost]>\n",
+    ])
+    stderr = io.StringIO()
+    with contextlib.redirect_stderr(stderr):
+        newdb = accdb.Database.parse(io.StringIO(text))
+    report_ = db.merge(newdb)
+    actual_output = {kind: [entry.name for entry in entries]
+                     for kind, entries in report_.items()}
+    wanted_output = {"new": ["Four"], "changed": ["Two"],
+                     "identical": ["One"], "broken": ["Five"]}
+    failed = 0
+    failed += report("merge report", actual_output == wanted_output,
+                     actual_output)
+    failed += report("merged entries", logins(db) == ["one", "two.b",
+                                                      "three", "four"]
+                     and db.modified, logins(db))
+    failed += report("merged entry numbers",
+                     [entry.itemno for entry in db] == [1, 2, 3, 4] and
+                     db.find_by_itemno(4).name == "Four",
+                     [entry.itemno for entry in db])
+    print("Tests: %d passed, %d failed" % (3 - failed, failed))
+    return failed
+
+def run_numbering_test(dir):
+    # After a save, the snapshot written along with the file must number
+    # entries the way parsing the file (or scanning it lazily) does.
+    path = os.path.join(dir, "numbering.db.txt")
+    with open(path, "w") as fh:
+        fh.write(db_text.replace("; dbflags: journal\n", ""))
+    failed = 0
+    steps = 0
+
+    db = accdb.Database.from_file(path)
+    delete(db, 2)
+    db.flush()
+    for step in ["delete", "merge", "sort"]:
+        if step == "sort":
+            db.sort()
+            db.touch()
+            db.modified = True
+        elif step == "merge":
+            db.merge(accdb.Database.parse(io.StringIO("= Alpha\n"
+                                                      "\tlogin: alpha\n")))
+        db.flush()
+        snapshot, lazy, parsed = loads(path)
+        failed += report("snapshot after %s" % step,
+                         items(snapshot) == items(parsed),
+                         [entry.name for entry in snapshot])
+        failed += report("lazy load after %s" % step,
+                         items(lazy) == items(parsed),
+                         [entry.name for entry in lazy])
+        steps += 2
+        db = accdb.Database.from_file(path)
+
+    print("Tests: %d passed, %d failed" % (steps - failed, failed))
+    return failed
+
+def run_lazy_test(dir):
+    # Commands that load lazily ("show", "copy") must see the same item
+    # numbers as the others ("ls", "grep"), also with changes that are
+    # only in the journal, and after the journal is merged into the file.
+    path = os.path.join(dir, "lazy.db.txt")
+    with open(path, "w") as fh:
+        fh.write(make_text(20, "journal"))
+    failed = 0
+    steps = ["delete", "sort", "compact", "delete", "merge", "compact"]
+
+    for step in steps:
+        db = accdb.Database.from_file(path)
+        if step == "delete":
+            delete(db, 5)
+        elif step == "sort":
+            db.sort()
+            db.touch()
+            db.modified = True
+        elif step == "merge":
+            db.merge(accdb.Database.parse(io.StringIO("= Alpha\n"
+                                                      "\tlogin: alpha\n")))
+        db.flush(compact=(step == "compact"))
+        full = accdb.Database.from_file(path)
+        lazy = accdb.Database.from_file(path, lazy=True)
+        actual_output = [lazy.find_by_itemno(itemno).name
+                         for itemno in [1, 5, 6, lazy.count]]
+        wanted_output = [full.find_by_itemno(itemno).name
+                         for itemno in [1, 5, 6, full.count]]
+        failed += report("lazy load after %s" % step,
+                         items(lazy) == items(full)
+                         and actual_output == wanted_output, actual_output)
+
+    print("Tests: %d passed, %d failed" % (len(steps) - failed, failed))
+    return failed
+
+def run_agent_test(dir):
+    path = os.path.join(dir, "agent.db.txt")
+    with open(path, "w") as fh:
+        fh.write(db_text)
+    failed = 0
+
+    accdb.db = accdb.Database.from_file(path)
+    agent = accdb.Agent(path)
+    agent.watcher = accdb.Watcher(path)
+    agent.base_stat = None
+    os.rename(path, path + ".old")
+    stderr = io.StringIO()
+    with contextlib.redirect_stderr(stderr):
+        agent.reload()
+    failed += report("reload of a missing file",
+                     logins(accdb.db) == ["one", "two", "three"]
+                     and "FileNotFoundError" in stderr.getvalue(),
+                     stderr.getvalue().strip())
+    os.rename(path + ".old", path)
+
+    # a client that never finishes its request
+    agent.TIMEOUT = 0.1
+    server, client = socket.socketpair()
+    with server, client:
+        client.sendall(b'{"args": ["ls"]')
+        try:
+            agent.handle(server)
+            actual_output = "no error"
+        except OSError as e:
+            actual_output = type(e).__name__
+    failed += report("stuck client", actual_output == "TimeoutError",
+                     actual_output)
+
+    print("Tests: %d passed, %d failed" % (2 - failed, failed))
+    return failed
+
+def run_hashlist_test(dir):
+    path = os.path.join(dir, "hashes.txt")
+    digests = sorted("%040X" % (i * 0x2468ACE13579BDF0FEDCBA9 % 2**160)
+                     for i in range(1, 50))
+    with open(path, "w") as fh:
+        # no newline after the last line
+        fh.write("\n".join("%s:%d" % (digest, 100 + i)
+                           for i, digest in enumerate(digests)))
+    with accdb.HashList(path) as hashes:
+        actual_output = [hashes.lookup(digest.lower())
+                         for digest in [digests[0], digests[25], digests[-1],
+                                        "0" * 40, "F" * 40]]
+    wanted_output = [100, 125, 148, 0, 0]
+    f = report("hash list lookups", actual_output == wanted_output,
+               actual_output)
+    print("Tests: %d passed, %d failed" % (1 - f, f))
+    return f
+
+def run_names_test():
+    text = "".join("= Example %d\n\tlogin: ex%d\n" % (i, i) for i in range(30))
+    db = accdb.Database.parse(io.StringIO("= ***\n= -- \n" + text))
+    failed = 0
+
+    try:
+        db.sort()
+        actual_output = [entry.name for entry in db][:3]
+    except AttributeError as e:
+        actual_output = str(e)
+    failed += report("sort names without letters",
+                     actual_output == ["***", "--", "Example 0"],
+                     actual_output)
+
+    # most of the best matches are deleted, after the index is built
+    db.names.search("exampel")
+    for itemno in range(3, 23):
+        delete(db, itemno)
+    actual_output = [db.find_by_itemno(itemno).name
+                     for score, itemno in db.names.search("exampel", 5)]
+    failed += report("fuzzy search skips deleted entries",
+                     len(actual_output) == 5 and
+                     not any(db.find_by_itemno(itemno).deleted
+                             for score, itemno in db.names.search("exampel")),
+                     actual_output)
+
+    print("Tests: %d passed, %d failed" % (2 - failed, failed))
+    return failed
+
+dir = tempfile.mkdtemp(prefix="accdb-tests.")
+try:
+    f = 0
+    f += run_planner_test()
+    f += run_load_test(dir)
+    f += run_merge_test()
+    f += run_names_test()
+    f += run_journal_test(dir)
+    f += run_numbering_test(dir)
+    f += run_lazy_test(dir)
+    f += run_agent_test(dir)
+    f += run_hashlist_test(dir)
+finally:
+    shutil.rmtree(dir)
+
+print("Total: %d failed" % f)
+
+sys.exit(f > 0)